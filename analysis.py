@@ -10,6 +10,7 @@ import shutil
 from read import *
 from compression import *
 from date_extraction import *
+from window_cache import WindowCache
 
 sf = r'E:\hurricane\dates\hurricane_data_dates.txt'
 # "storm files'
@@ -47,6 +48,9 @@ preeffect_min = 5
 # minimum number of days of a pre-effect window
 preeffect_max = 10
 # maximum number of days of a pre-effect window
+segment_method = 'greedy'
+# the engine used to segment the pre-effect search window. 'greedy' splits segments top-down until all are under
+# the threshold; 'pelt' finds the optimal segmentation for a penalty derived from the threshold
 
 stormstart_window = 5
 # the storm onset is defined as the day where the recorded rainfall is at its maximum, within a window that is
@@ -58,6 +62,12 @@ stormstart_min = 2
 longterm_width = 365
 # a defunct parameter that was used to calculate the stddev of a long, fixed window before the storm impact
 
+window_cache_loc = None
+# path to an SQLite file for caching pre-effect windows between runs, e.g. r'E:\hurricane\window_cache.sqlite'.
+# None disables the cache. Should not be inside the out folder, which is deleted on every run
+window_cache_size = 1000000
+# the maximum number of cached pre-effect windows
+
 
 #######
 
@@ -66,6 +76,11 @@ if os.path.isdir(out):
 
 os.mkdir(out)
 
+if window_cache_loc is not None:
+    window_cache = WindowCache(window_cache_loc, max_entries=window_cache_size)
+else:
+    window_cache = None
+
 gauge_dates = relate_gauges_to_storms(sf, sef)
 gauge_nums = list(gauge_dates.keys())
 gauge_files = [f'{i}.csv' for i in gauge_nums]
@@ -99,6 +114,15 @@ for i, (gauge, storm_dates) in enumerate(gauge_dates_mod.items()):
     print(f'Gauge {gauge}, {i + 1} of {len(gauge_dates_mod)}')
     data = station_dfs[gauge]
 
+    typical_stddevs = {}
+    # the typical stddev at every index of each param, found once per gauge rather than once per storm
+    for param in params_of_interest:
+        try:
+            typical_stddevs[param] = typical_stddev_series(data[param], history_length=stddev_history,
+                                                           window_size=stddev_window, step=stddev_step)
+        except TypeError:  # happens with malformed data. warned about for each storm below
+            typical_stddevs[param] = None
+
     for storm, date in storm_dates.items():
         mask = data['Date'] == date
         storm_row = data[mask]
@@ -112,9 +136,9 @@ for i, (gauge, storm_dates) in enumerate(gauge_dates_mod.items()):
 
         for param in params_of_interest:
             try:
-                max_error = typical_stddev(data[param], at_index=storm_ind,
-                                           history_length=stddev_history,
-                                           window_size=stddev_window, step=stddev_step) * stddvs_for_error
+                if typical_stddevs[param] is None:
+                    raise TypeError
+                max_error = typical_stddevs[param][storm_ind] * stddvs_for_error
                 # max_error is the maximum e^2_norm threshold allowed when recursively segmenting the pre-effect window
             except TypeError:  # happens with malformed data
                 warnings.warn(f'TypeError: malformation on {gauge, param}')
@@ -136,17 +160,17 @@ for i, (gauge, storm_dates) in enumerate(gauge_dates_mod.items()):
                            np.nan,  # dropped short points
                            ]
             else:
-                window = get_preeffect_window(data,
-                                              why_col=param,
-                                              threshold=max_error,
-                                              index=storm_ind,
-                                              width=preeffect_width,
-                                              min_win=preeffect_min,
-                                              max_win=preeffect_max)
+                window, pre_stats = preeffect_analysis(data,
+                                                       why_col=param,
+                                                       threshold=max_error,
+                                                       index=storm_ind,
+                                                       width=preeffect_width,
+                                                       min_win=preeffect_min,
+                                                       max_win=preeffect_max,
+                                                       method=segment_method,
+                                                       cache=window_cache)
                 window_len = window[1] - window[0]
-                pre_mean, pre_stddev, pre_n, dropped_short_points = analyze_window(data,
-                                                                                   why_col=param,
-                                                                                   window=window)
+                pre_mean, pre_stddev, pre_n, dropped_short_points = pre_stats
 
                 # long_window = (window[1]-longterm_width, window[1])
                 # long_mean, long_stddev, long_n, dropped_long_points = analyze_window(data,
@@ -170,6 +194,10 @@ for i, (gauge, storm_dates) in enumerate(gauge_dates_mod.items()):
             # print(appender)
             outputs[param] = outputs[param].append(appender, ignore_index=True)
 
+if window_cache is not None:
+    print(f'Pre-effect window cache: {window_cache.hits} hits, {window_cache.misses} misses')
+    window_cache.close()
+
 for param, df in outputs.items():
     if protect_gauge_nums:
         df['Gauge'] = "'" + df['Gauge'].astype(str)
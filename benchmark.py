@@ -0,0 +1,77 @@
+"""
+Timing comparisons between the optimized functions and the simple loops they replaced. Run as a script
+"""
+
+import timeit
+
+import numpy as np
+
+from read import *
+from detrend import detrend_discontinuous, detrend_climatology
+
+np.random.seed(2)
+
+
+def window_stddev_loop(whys, window_size, step=1):
+    """
+    The original loop implementation of read.window_stddev, kept as a reference
+    """
+    devs = []
+    for i in range(0, len(whys)-window_size, step):
+        sub_y = np.array(whys[i:(i + (window_size - 1))])
+        sub_y = sub_y[~np.isnan(sub_y)]
+        if len(sub_y) < 2:
+            devs.append(np.nan)
+        else:
+            dev = np.std(sub_y)
+            devs.append(dev)
+
+    if not all(np.isnan(x) for x in devs):
+        return np.mean(devs)
+    else:
+        return np.nan
+
+
+def compare(name, new, old, number=2000):
+    """
+    Times two zero-argument callables and prints the speedup and their (mean) results
+
+    Args:
+        name: label for the comparison
+        new: the optimized callable
+        old: the reference callable
+        number: the number of calls to time
+
+    Returns:
+        Nothing
+
+    """
+    t_new = timeit.timeit(new, number=number) / number
+    t_old = timeit.timeit(old, number=number) / number
+    print(f'{name}: {round(t_old*1e6, 1)} us -> {round(t_new*1e6, 1)} us ({round(t_old/t_new, 1)}x). '
+          f'Results: {np.nanmean(old())} vs {np.nanmean(new())}')
+
+
+if __name__ == '__main__':
+    # a 56 day history with a 14 day window, as in analysis.py
+    history = np.random.normal(7, 0.5, 56)
+    history[[3, 20, 21, 40]] = np.nan
+    compare('window_stddev', lambda: window_stddev(history, 14, 2), lambda: window_stddev_loop(history, 14, 2))
+
+    # the vectorized version must give the same bits as the loop, including with gaps
+    histories = np.random.normal(7, 0.5, (2000, 56))
+    histories[np.random.random(histories.shape) < 0.1] = np.nan
+    n_diff = sum(not np.array_equal(window_stddev(h, 14, 2), window_stddev_loop(h, 14, 2), equal_nan=True)
+                 for h in histories)
+    print(f'window_stddev: {n_diff} of {len(histories)} gappy histories differ from the loop')
+
+    # a 30 year daily DO-like series with a seasonal cycle and gaps, detrended as DO is in processing.py
+    dates = pd.date_range('1990-01-01', '2019-12-31')
+    days = np.arange(len(dates))
+    do = 9 + 2.5*np.cos(2*np.pi*days/365.25) + np.random.normal(0, 0.5, len(dates))
+    do[np.random.random(len(dates)) < 0.05] = np.nan
+    for start in np.random.randint(0, len(dates) - 200, 20):
+        do[start:start + np.random.randint(10, 150)] = np.nan
+    do_t = pd.RangeIndex(len(dates))
+    compare('detrend DO', lambda: detrend_climatology(dates, do),
+            lambda: detrend_discontinuous(do_t, do, 1, 28, 'high', max_gap=56, aligned=True), number=20)
@@ -6,6 +6,7 @@ This is a common form of time series data compression.
 # NOTE: e norm here is NOT standard error: it is length-averaged error
 
 from itertools import chain
+from collections import deque
 
 import numpy as np
 from scipy.optimize import curve_fit
@@ -84,6 +85,84 @@ def get_line(exes, whys, start_end, return_e=False):
         return m, b, e_norm
 
 
+def cumulative_sums(exes, whys):
+    """
+    Precomputes the cumulative sums of x, y, x^2, xy and y^2 for a data series so that the least-squares line for
+    any contiguous subset can be found in constant time. The data is shifted by its mean before summing to keep the
+    sums well conditioned
+
+    Args:
+        exes: the x values in the series
+        whys: the y values in the series
+
+    Returns: a tuple (x_ref, y_ref, sx, sy, sxx, sxy, syy), where x_ref and y_ref are the shifts applied to the data
+             and each s array has len(exes)+1 entries, with s[i] being the sum of the first i terms
+
+    """
+    x = np.asarray(exes, dtype=float)
+    y = np.asarray(whys, dtype=float)
+    x_ref = np.mean(x)
+    y_ref = np.mean(y)
+    x = x - x_ref
+    y = y - y_ref
+
+    def cum(vals):
+        return np.concatenate(([0.], np.cumsum(vals)))
+
+    return x_ref, y_ref, cum(x), cum(y), cum(x*x), cum(x*y), cum(y*y)
+
+
+def fit_from_sums(sums, starts, ends):
+    """
+    Fits least-squares lines to one or more subsets of a series using the output of cumulative_sums
+
+    Args:
+        sums: the output of cumulative_sums
+        starts: the start (inclusive) of each subset. May be an int or an array
+        ends: the end (exclusive) of each subset. May be an int or an array
+
+    Returns: a tuple (m, b, e) where e is the sum of the squared errors of each fit
+
+    """
+    x_ref, y_ref, sx, sy, sxx, sxy, syy = sums
+    n = ends - starts
+    s_x = sx[ends] - sx[starts]
+    s_y = sy[ends] - sy[starts]
+    # centered (co)variances of each subset
+    c_xx = (sxx[ends] - sxx[starts]) - s_x * s_x / n
+    c_xy = (sxy[ends] - sxy[starts]) - s_x * s_y / n
+    c_yy = (syy[ends] - syy[starts]) - s_y * s_y / n
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m = np.where(c_xx > 0, c_xy / c_xx, 0.)
+        e = np.where(c_xx > 0, c_yy - m * c_xy, c_yy)
+    e = np.where(n > 2, np.maximum(e, 0.), 0.)  # two points always fit exactly; cancellation can leave noise
+    b = (s_y / n + y_ref) - m * (s_x / n + x_ref)
+
+    return m, b, e
+
+
+def get_line_from_sums(sums, start_end, return_e=False):
+    """
+    Like get_line, but uses the precomputed output of cumulative_sums so the fit takes constant time
+
+    Args:
+        sums: the output of cumulative_sums
+        start_end: a list of len 2 indicating the start (inclusive) and end (exclusive) of the subset.
+                   Does not need to be ordered
+    Returns: A tuple (m, b, e_norm)
+    """
+    start, end = sorted(start_end)
+    m, b, e = fit_from_sums(sums, start, end)
+    m, b, e = float(m), float(b), float(e)
+    e_norm = e / (start_end[1] - start_end[0])
+
+    if return_e:
+        return m, b, e_norm, e
+    else:
+        return m, b, e_norm
+
+
 '''
 def trawl(exes, whys, start, threshold=0.8, step=-1):
     """
@@ -126,7 +205,7 @@ def trawl(exes, whys, start, threshold=0.8, step=-1):
 '''
 
 
-def split_segment(exes, whys, segment):
+def split_segment(exes, whys, segment, sums=None, stride=1, refine=1, tol=None):
     """
     Takes a segment of a data series and splits it into two segments, where the new segments have optimal
     linear fits based on minimizing the sum of the squared errors
@@ -135,9 +214,25 @@ def split_segment(exes, whys, segment):
         exes: the x values in the series
         whys: the y values in the series
         segment: a list of len 2 indicating the start (inclusive) and end (exclusive) of the subset
+        sums: optional output of cumulative_sums for the series. If passed, all candidate splits are evaluated
+              at once in constant time each instead of refitting every candidate
+        stride: if greater than 1, the split is found approximately by only evaluating every stride-th candidate and
+                then searching exhaustively within stride of the best ones. Uses sums, computing them if needed
+        refine: the number of best strided candidates to search around. Larger values bring the result closer to
+                the exact search, but give no bound on how far from it the result can be. See split_gap
+        tol: if given, refine is ignored and the approximate search is bounded instead: the summed squared error of
+             the split is at most (1 + tol) times that of the exact search (up to rounding in the sums), and 0 gives
+             the exact split. The left fit's error can only grow and the right fit's only shrink as the split
+             moves right, so the errors at two neighbouring strided candidates bound every split between them, and
+             only the stretches whose bound could beat the best strided candidate by more than tol are searched
 
     Returns: a tuple with two sublists containing the start and end of each new segment and r2
     """
+    if stride > 1 and sums is None:
+        sums = cumulative_sums(exes, whys)
+    if sums is not None:
+        return _split_segment_sums(sums, segment, stride=stride, refine=refine, tol=tol)
+
     if segment[1] - segment[0] == 3:
         seg1 = [segment[0], segment[0]+2]
         seg2 = [segment[1]-2, segment[1]]
@@ -169,6 +264,83 @@ def split_segment(exes, whys, segment):
     return win_segs
 
 
+def _split_costs(sums, segment, splits):
+    """
+    Gets the squared errors of the two segments on either side of each candidate split of a segment
+    """
+    e1 = fit_from_sums(sums, segment[0], splits)[2]
+    e2 = fit_from_sums(sums, splits-1, segment[1])[2]
+    return e1, e2
+
+
+def _split_segment_sums(sums, segment, stride=1, refine=1, tol=None):
+    """
+    split_segment using the output of cumulative_sums
+    """
+    if segment[1] - segment[0] == 3:
+        seg1 = [segment[0], segment[0]+2]
+        seg2 = [segment[1]-2, segment[1]]
+        e_norm1 = get_line_from_sums(sums, seg1)[2]
+        e_norm2 = get_line_from_sums(sums, seg2)[2]
+        return [[seg1[0], seg1[1], e_norm1], [seg2[0], seg2[1], e_norm2]]
+
+    splits = np.arange(segment[0]+2, segment[1]-1)
+    if len(splits) == 0:
+        return []
+
+    if stride > 1 and len(splits) > stride and tol is not None:
+        coarse = np.append(splits[:-1:stride], splits[-1])
+        coarse_e1, coarse_e2 = _split_costs(sums, segment, coarse)
+        best_e = np.min(coarse_e1 + coarse_e2)
+        # no split between coarse[k] and coarse[k+1] can cost less than this
+        lower = coarse_e1[:-1] + coarse_e2[1:]
+        open_gaps = np.flatnonzero(lower * (1 + tol) <= best_e)
+        near = [coarse] + [np.arange(coarse[k] + 1, coarse[k+1]) for k in open_gaps]
+        splits = np.unique(np.concatenate(near))
+    elif stride > 1 and len(splits) > stride:
+        coarse = splits[::stride]
+        coarse_e1, coarse_e2 = _split_costs(sums, segment, coarse)
+        bests = coarse[np.argsort(coarse_e1 + coarse_e2, kind='stable')[:refine]]
+        near = np.unique(np.concatenate([np.arange(b - stride + 1, b + stride) for b in bests]))
+        splits = near[(near >= splits[0]) & (near <= splits[-1])]
+
+    e1, e2 = _split_costs(sums, segment, splits)
+
+    best = int(np.argmin(e1 + e2))  # first minimum, same as the tie-breaking of the brute force search
+    i = int(splits[best])
+    win_e_norm1 = float(e1[best]) / (i - segment[0])
+    win_e_norm2 = float(e2[best]) / (segment[1] - (i-1))
+    return [[segment[0], i, win_e_norm1], [i-1, segment[1], win_e_norm2]]
+
+
+def split_gap(sums, segment, stride, refine=1, tol=None):
+    """
+    Measures how much worse the approximate split of a segment is than the exact split, to help choose the
+    stride and refine arguments of split_segment for a workload
+
+    Args:
+        sums: the output of cumulative_sums for the series
+        segment: a list of len 2 indicating the start (inclusive) and end (exclusive) of the subset
+        stride: the stride of the approximate search
+        refine: the number of strided candidates refined in the approximate search
+        tol: the accuracy bound of the approximate search, see split_segment
+
+    Returns: a tuple (exact_e, approx_e, gap), where the e values are the summed squared errors of the two new
+             segments and gap is the relative increase of approx_e over exact_e
+
+    """
+    def total_e(split):
+        e1 = split[0][2] * (split[0][1] - split[0][0])
+        e2 = split[1][2] * (split[1][1] - split[1][0])
+        return e1 + e2
+
+    exact_e = total_e(_split_segment_sums(sums, segment))
+    approx_e = total_e(_split_segment_sums(sums, segment, stride=stride, refine=refine, tol=tol))
+    gap = (approx_e - exact_e) / exact_e if exact_e > 0 else 0.
+
+    return exact_e, approx_e, gap
+
+
 def flatten(x):
     """
     Creates a generator object that loops through a nested list
@@ -204,7 +376,7 @@ def regroup(x, n):
     return new_list
 
 
-def linear_recurse(exes, whys, threshold=1, segments=None):
+def linear_recurse(exes, whys, threshold=1, segments=None, sums=None):
     """
     Recursively breaks a data series into segments until the e^2_norm for all segments is under the threshold.
     Data cannot have any None, nan, etc. values
@@ -214,20 +386,420 @@ def linear_recurse(exes, whys, threshold=1, segments=None):
         whys: the y values in the series
         threshold: the e^2_norm threshold that all segments should be under
         segments: an optional list of lists that indicate the segment slices to start with and corresponding e^2_norm
+        sums: optional output of cumulative_sums for the series, which makes each split linear rather than
+              quadratic in the segment length. Pass True to have it computed here
 
     Returns: a tuple of lists, where each list is the start (incl), end (excl) and r2 of each segment
     """
+    if sums is True:
+        sums = cumulative_sums(exes, whys)
 
     if segments is None:
         start_end = [0, len(exes)]
-        segments = [[start_end[0], start_end[1], get_line(exes, whys, start_end)[2]]]
+        if sums is None:
+            e_norm = get_line(exes, whys, start_end)[2]
+        else:
+            e_norm = get_line_from_sums(sums, start_end)[2]
+        segments = [[start_end[0], start_end[1], e_norm]]
 
     #print(f'New segs: {segments}')
-    segments = [split_segment(exes,whys,seg) if seg[2] > threshold else seg for seg in segments]
+    segments = [split_segment(exes,whys,seg,sums=sums) if seg[2] > threshold else seg for seg in segments]
     flattened = [i for i in flatten(segments)]
     segments = regroup(flattened, 3)
     #print(f'New Segments: {segments}')
     if all(seg[2] <= threshold for seg in segments):
         return segments
     else:
-        return linear_recurse(exes, whys, threshold=threshold, segments=segments)
\ No newline at end of file
+        return linear_recurse(exes, whys, threshold=threshold, segments=segments, sums=sums)
+
+
+def linear_iterate(exes, whys, threshold=1, segments=None, sums=None, stride=1, refine=1, tol=None):
+    """
+    Gives the same result as linear_recurse, but splits segments from a work stack instead of recursing. Only
+    segments still over the threshold are revisited, and segments are held in preallocated arrays rather than
+    rebuilt as nested lists on every pass, so long series cannot hit the recursion limit.
+    Data cannot have any None, nan, etc. values
+
+    Args:
+        exes: the x values in the series
+        whys: the y values in the series
+        threshold: the e^2_norm threshold that all segments should be under
+        segments: an optional list of lists that indicate the segment slices to start with and corresponding e^2_norm
+        sums: optional output of cumulative_sums for the series. Pass True to have it computed here
+        stride: the stride of the approximate split search (see split_segment). 1 gives the exact search
+        refine: the number of strided candidates refined in the approximate split search
+        tol: the accuracy bound of the approximate split search, see split_segment. Replaces refine if given
+
+    Returns: a list of lists, where each list is the start (incl), end (excl) and e^2_norm of each segment
+    """
+    if sums is True or (stride > 1 and sums is None):
+        sums = cumulative_sums(exes, whys)
+
+    if segments is None:
+        start_end = [0, len(exes)]
+        if sums is None:
+            e_norm = get_line(exes, whys, start_end)[2]
+        else:
+            e_norm = get_line_from_sums(sums, start_end)[2]
+        segments = [[start_end[0], start_end[1], e_norm]]
+
+    # every split adds one segment and segments overlap by at most one point, so this bounds both arrays
+    capacity = max(len(exes), len(segments)) + 1
+    stack_se = np.empty((capacity, 2), dtype=int)
+    stack_e = np.empty(capacity)
+    out_se = np.empty((capacity, 2), dtype=int)
+    out_e = np.empty(capacity)
+
+    # the stack is popped from the top, so push in reverse to emit segments in order
+    top = 0
+    for seg in reversed(segments):
+        stack_se[top] = seg[0], seg[1]
+        stack_e[top] = seg[2]
+        top += 1
+
+    n_out = 0
+    while top > 0:
+        top -= 1
+        start, end = int(stack_se[top, 0]), int(stack_se[top, 1])
+        e_norm = stack_e[top]
+        if e_norm <= threshold:
+            out_se[n_out] = start, end
+            out_e[n_out] = e_norm
+            n_out += 1
+            continue
+
+        for seg in reversed(split_segment(exes, whys, [start, end], sums=sums, stride=stride, refine=refine,
+                                          tol=tol)):
+            stack_se[top] = seg[0], seg[1]
+            stack_e[top] = seg[2]
+            top += 1
+
+    return [[int(se[0]), int(se[1]), float(e)] for se, e in zip(out_se[:n_out], out_e[:n_out])]
+
+
+def split_tree(exes, whys, sums=None):
+    """
+    Builds the full binary tree of greedy splits for a data series, splitting every segment with split_segment until
+    no segment can be split further. Cutting the tree with cut_tree gives the same segments linear_recurse would
+    for any threshold, so the threshold can be changed without segmenting the series again.
+    Data cannot have any None, nan, etc. values
+
+    Args:
+        exes: the x values in the series
+        whys: the y values in the series
+        sums: optional output of cumulative_sums for the series. Computed here if not passed
+
+    Returns: a tuple of arrays (starts, ends, e_norms, lefts, rights) describing each node, where the root is node 0
+             and lefts/rights give the indices of each node's children (-1 for leaves)
+    """
+    if sums is None:
+        sums = cumulative_sums(exes, whys)
+
+    n = len(exes)
+    capacity = 2 * max(n, 1)  # a split tree over n points has fewer than 2n nodes
+    starts = np.empty(capacity, dtype=int)
+    ends = np.empty(capacity, dtype=int)
+    e_norms = np.empty(capacity)
+    lefts = np.full(capacity, -1, dtype=int)
+    rights = np.full(capacity, -1, dtype=int)
+
+    starts[0], ends[0] = 0, n
+    e_norms[0] = get_line_from_sums(sums, [0, n])[2]
+    n_nodes = 1
+    to_split = [0]
+    while to_split:
+        node = to_split.pop()
+        if ends[node] - starts[node] < 3:
+            continue
+        children = split_segment(exes, whys, [int(starts[node]), int(ends[node])], sums=sums)
+        if not children:
+            continue
+        lefts[node], rights[node] = n_nodes, n_nodes + 1
+        for seg in children:
+            starts[n_nodes], ends[n_nodes], e_norms[n_nodes] = seg
+            to_split.append(n_nodes)
+            n_nodes += 1
+
+    return starts[:n_nodes], ends[:n_nodes], e_norms[:n_nodes], lefts[:n_nodes], rights[:n_nodes]
+
+
+def cut_tree(tree, threshold=1):
+    """
+    Gets the segments of a split tree for a threshold
+
+    Args:
+        tree: the output of split_tree
+        threshold: the e^2_norm threshold that all segments should be under
+
+    Returns: a list of lists, where each list is the start (incl), end (excl) and e^2_norm of each segment
+    """
+    starts, ends, e_norms, lefts, rights = tree
+
+    segments = []
+    to_visit = [0]
+    while to_visit:
+        node = to_visit.pop()
+        if e_norms[node] <= threshold:
+            segments.append([int(starts[node]), int(ends[node]), float(e_norms[node])])
+        elif lefts[node] != -1:
+            to_visit.extend([rights[node], lefts[node]])
+
+    return segments
+
+
+def segment_many(series, thresholds=1):
+    """
+    Segments many data series at once, giving the same result as running linear_recurse on each. All series are
+    split a level at a time, with the fits for every candidate split of every series evaluated together, so the
+    Python overhead per series is small even when the series are short.
+    Data cannot have any None, nan, etc. values
+
+    Args:
+        series: a list of (exes, whys) tuples. The series may have different lengths
+        thresholds: the e^2_norm threshold for each series, or a single threshold for all of them
+
+    Returns: a list with one entry per series, where each entry is a list of lists giving the start (incl),
+             end (excl) and e^2_norm of each segment of that series
+    """
+    series = list(series)
+    if not series:
+        return []
+
+    lengths = np.array([len(exes) for exes, whys in series], dtype=int)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    thresholds = np.broadcast_to(np.asarray(thresholds, dtype=float), lengths.shape)
+
+    # each series is shifted by its own mean so the shared running sums stay well conditioned
+    x = np.concatenate([np.asarray(exes, dtype=float) - np.mean(exes) for exes, whys in series])
+    y = np.concatenate([np.asarray(whys, dtype=float) - np.mean(whys) for exes, whys in series])
+    sums = cumulative_sums(x, y)
+    sums = (0., 0.) + sums[2:]
+
+    seg_ids = np.arange(len(series))
+    starts, ends = offsets[:-1].copy(), offsets[1:].copy()
+    e_norms = fit_from_sums(sums, starts, ends)[2] / lengths
+
+    done_ids, done_starts, done_ends, done_e_norms = [], [], [], []
+    while len(seg_ids):
+        final = e_norms <= thresholds[seg_ids]
+        done_ids.append(seg_ids[final])
+        done_starts.append(starts[final])
+        done_ends.append(ends[final])
+        done_e_norms.append(e_norms[final])
+
+        seg_ids, starts, ends = seg_ids[~final], starts[~final], ends[~final]
+        # candidate splits run from start+2 to end-2, except for the obligate split of three points into two pairs.
+        # segments with no candidates are dropped, as in split_segment
+        n_cand = np.where(ends - starts == 3, 1, np.maximum(ends - starts - 3, 0))
+        has_cand = n_cand > 0
+        seg_ids, starts, ends, n_cand = seg_ids[has_cand], starts[has_cand], ends[has_cand], n_cand[has_cand]
+        if not len(seg_ids):
+            break
+
+        owner = np.repeat(np.arange(len(seg_ids)), n_cand)
+        first = np.concatenate(([0], np.cumsum(n_cand)[:-1]))
+        splits = starts[owner] + 2 + (np.arange(len(owner)) - first[owner])
+        e1 = fit_from_sums(sums, starts[owner], splits)[2]
+        e2 = fit_from_sums(sums, splits - 1, ends[owner])[2]
+        totals = e1 + e2
+
+        # the first minimum of each segment's candidates, as in split_segment
+        mins = np.minimum.reduceat(totals, first)
+        is_min = np.flatnonzero(totals == mins[owner])
+        best = is_min[np.unique(owner[is_min], return_index=True)[1]]
+
+        split = splits[best]
+        left_e_norms = e1[best] / (split - starts)
+        right_e_norms = e2[best] / (ends - split + 1)
+        seg_ids = np.concatenate((seg_ids, seg_ids))
+        starts, ends = np.concatenate((starts, split - 1)), np.concatenate((split, ends))
+        e_norms = np.concatenate((left_e_norms, right_e_norms))
+
+    done_ids = np.concatenate(done_ids)
+    done_starts = np.concatenate(done_starts)
+    done_ends = np.concatenate(done_ends)
+    done_e_norms = np.concatenate(done_e_norms)
+    order = np.lexsort((done_starts, done_ids))
+
+    results = [[] for _ in series]
+    for k in order:
+        offset = offsets[done_ids[k]]
+        results[done_ids[k]].append([int(done_starts[k] - offset), int(done_ends[k] - offset),
+                                     float(done_e_norms[k])])
+
+    return results
+
+
+def pelt_segment(exes, whys, threshold=1, penalty=None, min_size=2, sums=None):
+    """
+    Breaks a data series into the globally optimal set of linear segments by minimizing the total sum of squared
+    errors plus a penalty for each segment (optimal partitioning). Candidate segment starts that can never be
+    optimal again are pruned as in PELT (Killick et al. 2012), so run time is close to linear in practice.
+    Unlike linear_recurse, the segments do not share their boundary points.
+    Data cannot have any None, nan, etc. values
+
+    Args:
+        exes: the x values in the series
+        whys: the y values in the series
+        threshold: the tolerated e^2_norm of a segment. Only used to set the default penalty
+        penalty: the cost of adding a segment. Defaults to 3*threshold*ln(n), a BIC-like penalty for the slope,
+                 intercept and breakpoint of each segment with threshold taken as the noise variance
+        min_size: the minimum number of points in a segment
+        sums: optional output of cumulative_sums for the series
+
+    Returns: a list of lists, where each list is the start (incl), end (excl) and e^2_norm of each segment
+    """
+    n = len(exes)
+    if sums is None:
+        sums = cumulative_sums(exes, whys)
+    if penalty is None:
+        penalty = 3 * threshold * np.log(max(n, 2))
+
+    if n < 2 * min_size:
+        e = fit_from_sums(sums, 0, n)[2]
+        return [[0, n, float(e) / n]]
+
+    costs = np.full(n + 1, np.inf)  # costs[t] is the optimal penalized cost of the first t points
+    costs[0] = -penalty
+    last = np.zeros(n + 1, dtype=int)  # last[t] is the start of the final segment in that optimal partition
+    candidates = np.array([0])
+
+    for t in range(min_size, n + 1):
+        valid = candidates[t - candidates >= min_size]
+        seg_e = fit_from_sums(sums, valid, t)[2]
+        totals = costs[valid] + seg_e + penalty
+        best = int(np.argmin(totals))
+        costs[t] = totals[best]
+        last[t] = valid[best]
+
+        # a start that is already worse than the optimum (before the penalty) can never become optimal again
+        keep = np.ones(len(candidates), dtype=bool)
+        keep[t - candidates >= min_size] = costs[valid] + seg_e <= costs[t]
+        candidates = np.append(candidates[keep], t)
+
+    segments = []
+    end = n
+    while end > 0:
+        start = int(last[end])
+        e = fit_from_sums(sums, start, end)[2]
+        segments.append([start, end, float(e) / (end - start)])
+        end = start
+    segments.reverse()
+
+    return segments
+
+
+def bottom_up(exes, whys, threshold=1, sums=None):
+    """
+    Breaks a data series into segments by starting with segments of two points and repeatedly merging the
+    neighboring pair whose merged e^2_norm is smallest until no merge would be under the threshold.
+    Segments do not share their boundary points.
+    Data cannot have any None, nan, etc. values
+
+    Args:
+        exes: the x values in the series
+        whys: the y values in the series
+        threshold: the e^2_norm threshold that all merged segments should be under
+        sums: optional output of cumulative_sums for the series
+
+    Returns: a list of lists, where each list is the start (incl), end (excl) and e^2_norm of each segment
+    """
+    n = len(exes)
+    if sums is None:
+        sums = cumulative_sums(exes, whys)
+
+    bounds = list(range(0, n - 1, 2))
+    if not bounds:
+        bounds = [0]
+    bounds.append(n)  # a trailing odd point joins the last pair
+
+    def merged_e_norm(k):
+        # e^2_norm of joining segment k with segment k+1
+        start, end = bounds[k], bounds[k+2]
+        return float(fit_from_sums(sums, start, end)[2]) / (end - start)
+
+    merge_e = [merged_e_norm(k) for k in range(len(bounds) - 2)]
+    while merge_e:
+        k = int(np.argmin(merge_e))
+        if merge_e[k] > threshold:
+            break
+        del bounds[k+1]
+        del merge_e[k]
+        if k < len(merge_e):
+            merge_e[k] = merged_e_norm(k)
+        if k > 0:
+            merge_e[k-1] = merged_e_norm(k-1)
+
+    segments = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        e = fit_from_sums(sums, start, end)[2]
+        segments.append([start, end, float(e) / (end - start)])
+
+    return segments
+
+
+class StreamSegmenter:
+    """
+    Segments a series that arrives a point at a time using a sliding window and bottom-up merging (SWAB,
+    Keogh et al. 2001). Points are held in a buffer of bounded size; whenever it fills, the buffer is segmented with
+    bottom_up and its leftmost segment, which further points can no longer change, is emitted and dropped.
+    e^2_norm is defined as in get_line, so thresholds from linear_recurse carry over
+
+    Args:
+        threshold: the e^2_norm threshold that all segments should be under
+        buffer_size: the maximum number of points held before the leftmost segment is emitted
+    """
+
+    def __init__(self, threshold=1, buffer_size=70):
+        if buffer_size < 4:
+            raise ValueError('buffer_size must be at least 4')
+        self.threshold = threshold
+        self.buffer_size = buffer_size
+        self.exes = deque()
+        self.whys = deque()
+        self.offset = 0  # the absolute index of the first buffered point
+
+    def push(self, x, y):
+        """
+        Adds a point to the series
+
+        Args:
+            x: the x value of the point
+            y: the y value of the point. Cannot be None, nan, etc.
+
+        Returns: a list of the segments finalized by this point, where each is a list of the ABSOLUTE start (incl),
+                 end (excl) and e^2_norm of the segment, with indices counting the points pushed so far
+
+        """
+        self.exes.append(x)
+        self.whys.append(y)
+        if len(self.exes) < self.buffer_size:
+            return []
+
+        segments = bottom_up(self.exes, self.whys, threshold=self.threshold)
+        start, end, e_norm = segments[0]
+        return [self._emit(end, e_norm)]
+
+    def flush(self):
+        """
+        Finalizes all buffered points, e.g. at the end of the series
+
+        Returns: a list of the remaining segments, formatted as in push
+
+        """
+        if not self.exes:
+            return []
+
+        segments = bottom_up(self.exes, self.whys, threshold=self.threshold)
+        return [self._emit(end - start, e_norm) for start, end, e_norm in segments]
+
+    def _emit(self, n_points, e_norm):
+        """
+        Drops the first n_points from the buffer and returns them as an absolute segment
+        """
+        for _ in range(n_points):
+            self.exes.popleft()
+            self.whys.popleft()
+        segment = [self.offset, self.offset + n_points, e_norm]
+        self.offset += n_points
+        return segment
@@ -43,6 +43,25 @@ def relate_gauges_to_storms(storm_file, storm_effect_folder, ext='.txt'):
     return gauges_to_storms
 
 
+def storm_windows(storm_file):
+    """
+    Gets the window of data that is of interest for each storm
+
+    Args:
+        storm_file: a csv that relates storm names to data windows, with at minimum headers 'DATASTART' and 'DATAEND'
+
+    Returns:
+        a list of (start, end) datetime pairs, one for each storm
+
+    """
+
+    storms = pd.read_csv(storm_file)
+    starts = pd.to_datetime(storms['DATASTART'], format='%Y/%m/%d')
+    ends = pd.to_datetime(storms['DATAEND'], format='%Y/%m/%d')
+
+    return [(start.to_pydatetime(), end.to_pydatetime()) for start, end in zip(starts, ends)]
+
+
 def onset_by_rain(date, df, window=5, rain_threshold=5):
     """
     Finds true storm onset by finding the first date around the landfall that rain exceeds a threshold
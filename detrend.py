@@ -1,4 +1,6 @@
 import os
+import pickle
+from functools import lru_cache
 
 from scipy import signal
 from scipy.signal import detrend as dt
@@ -6,6 +8,26 @@ from scipy.signal import detrend as dt
 from read import *
 
 
+def cutoff(fs, T):
+    """
+    Converts the filter period(s) used by detrend to normalized frequencies
+
+    Args:
+        fs: the sampling FREQUENCY of the data
+        T: the PERIOD or PERIODS (not frequency) for the filter
+
+    Returns:
+        the normalized frequency, or a sorted list of them if T has several periods
+    """
+    try:
+        w = [(1/i)/(fs/2) for i in T] # convert the period to frequency and normalize
+        w.sort()
+    except TypeError:
+        w = (1/T)/(fs/2) # convert the period to frequency and normalize
+
+    return w
+
+
 def detrend(x, fs, T, ftype, recenter=True):
     """
     Removes sinusoidal signals from a CONTINUOUS, REGULARLY sampled time series. Note that signals with a frequency
@@ -21,12 +43,7 @@ def detrend(x, fs, T, ftype, recenter=True):
     Returns:
         The detrended data as a np array
     """
-    try:
-        w = [(1/i)/(fs/2) for i in T] # convert the period to frequency and normalize
-        w.sort()
-    except TypeError:
-        w = (1/T)/(fs/2) # convert the period to frequency and normalize
-
+    w = cutoff(fs, T)
     b, a = signal.butter(5, w, ftype)
     res = signal.filtfilt(b, a, x)
 
@@ -36,6 +53,62 @@ def detrend(x, fs, T, ftype, recenter=True):
         return res
 
 
+@lru_cache(maxsize=None)
+def _sos_design(fs, T, ftype, order):
+    return signal.butter(order, cutoff(fs, T), ftype, output='sos')
+
+
+def filter_design(fs, T, ftype, order=5):
+    """
+    Designs the Butterworth filter used by detrend as second-order sections. Designs are memoized
+
+    Args:
+        fs: the sampling FREQUENCY of the data
+        T: the PERIOD or PERIODS (not frequency) for the filter
+        ftype: the filtering type. 'highpass', 'lowpass', 'bandpass', 'bandstop'
+        order: the filter order
+
+    Returns:
+        the filter as a np array of second-order sections
+
+    """
+    try:
+        T = tuple(T)
+    except TypeError:
+        pass
+    return _sos_design(fs, T, ftype, order)
+
+
+def continuous_bounds(whys, max_gap=0):
+    """
+    Finds sampling gaps and gives the bounds of the continuous stretches of the data, as in continuous_subsets,
+    without copying the data
+
+    Args:
+        whys: y values
+        max_gap: integer indicating maximum gap allowable to be considered continuous
+
+    Returns:
+        A tuple of two np arrays (starts, ends) giving the (inclusive:exclusive) positional indices of each
+        continuous stretch
+
+    """
+    gappy = np.isnan(np.asarray(whys))  # raises a TypeError for malformed (non-numeric) data
+    present = np.flatnonzero(~gappy)
+    if len(present) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int)
+
+    gap_lens = np.diff(present) - 1
+    breaks = np.flatnonzero(gap_lens > max_gap)
+
+    starts = np.concatenate(([present[0]], present[breaks + 1]))
+    ends = np.concatenate((present[breaks] + 1, [present[-1] + 1]))
+    if present[0] <= max_gap:  # an acceptable gap at the very start is kept, but one at the end is not
+        starts[0] = 0
+
+    return starts, ends
+
+
 def continuous_subsets(tees, whys, max_gap=0, repair=False):
     """
     Finds sampling gaps and divides the data into continuous samples
@@ -50,41 +123,11 @@ def continuous_subsets(tees, whys, max_gap=0, repair=False):
         A tuple of two lists of lists (t_cont, y_cont), each list representing the continuous stretches of the data
 
     """
+    starts, ends = continuous_bounds(whys, max_gap=max_gap)
 
-    groups_why = []
-    groups_tee = []
-    inner_why = []
-    inner_tee = []
-    y_pad = []
-    t_pad = []
-    n_gap = 0
-    for tee, why in zip(tees, whys):
-        if not np.isnan(why):  # if there's a number, definitely add it
-            # print(f'Good. Adding {tee,why} to inner set')
-            n_gap = 0  # add the pads in case an acceptable gap preceded
-            inner_why.extend(y_pad)
-            inner_tee.extend(t_pad)
-            y_pad, t_pad = [], []
-
-            inner_why.append(why)
-            inner_tee.append(tee)
-        else:
-            n_gap += 1
-            # print(f'Gap: {tee,why}. Gaplen is {n_gap} ({max_gap} allowable)')
-            y_pad.append(why)
-            t_pad.append(tee)
-            if n_gap > max_gap:
-                y_pad, t_pad = [], []
-                if inner_why != []:  # if we've exceeded the allowable gap
-                    # print(f'Gap exceeded. Adding {inner_tee[0:3], inner_why[0:3]} etc')
-                    groups_why.append(inner_why)
-                    groups_tee.append(inner_tee)
-                    inner_why, inner_tee = [], []
-
-    if inner_why != []:
-        groups_why.append(inner_why)
-        groups_tee.append(inner_tee)
-        # print('Final append')
+    whys = np.asarray(whys)
+    groups_tee = [list(tees[start:end]) for start, end in zip(starts, ends)]
+    groups_why = [list(whys[start:end]) for start, end in zip(starts, ends)]
 
     if repair and max_gap > 0:
         groups_why = [fill_gaps(tee,why) for tee,why in zip(groups_tee,groups_why)]
@@ -108,7 +151,7 @@ def fill_gaps(tee, why):
     return np.array(s)
 
 
-def detrend_discontinuous(t, x, fs, T, ftype, max_gap=0, recenter=True):
+def detrend_discontinuous(t, x, fs, T, ftype, max_gap=0, recenter=True, aligned=False):
     """
     Like detrend, but will split discontinuous data (and interpolate small gaps) before detrending.
 
@@ -120,12 +163,18 @@ def detrend_discontinuous(t, x, fs, T, ftype, max_gap=0, recenter=True):
         max_gap: the largest gap allowable for interpolation
         ftype: the filtering type. 'highpass', 'lowpass', 'bandpass', 'bandstop'
         recenter: if True, with output will have the same mean as the input
+        aligned: if True, the detrended stretches are written straight into a np array the length of x instead
 
     Returns:
         The detrended data as a pd Series. if the original data was discontinuous, there will be fewer entries in the
-        returned Series, but the index will still match up
+        returned Series, but the index will still match up. If aligned, a np array the same length as x that is nan
+        wherever x is nan
 
     """
+    if aligned:
+        return detrend_aligned(t, x, lambda sub: detrend(sub, fs, T, ftype, recenter=False),
+                               max_gap=max_gap, recenter=recenter)
+
 
     sub_tees, sub_exes = continuous_subsets(t, x, max_gap=max_gap, repair=True)
     d_exes = [detrend(sub, fs, T, ftype, recenter=False) for sub in sub_exes]
@@ -142,7 +191,7 @@ def detrend_discontinuous(t, x, fs, T, ftype, max_gap=0, recenter=True):
     c = crush_series(t, x, tees, exes)
     return c
 
-def detrend_discontinuous_linear(t, x, max_gap=0, recenter=True):
+def detrend_discontinuous_linear(t, x, max_gap=0, recenter=True, aligned=False):
     """
     Just removed the linear signal
 
@@ -151,12 +200,17 @@ def detrend_discontinuous_linear(t, x, max_gap=0, recenter=True):
         x: x data. may be gappy (has nans)
         max_gap: the largest gap allowable for interpolation
         recenter: if True, with output will have the same mean as the input
+        aligned: if True, the detrended stretches are written straight into a np array the length of x instead
 
     Returns:
         The detrended data as a pd Series. if the original data was discontinuous, there will be fewer entries in the
-        returned Series, but the index will still match up
+        returned Series, but the index will still match up. If aligned, a np array the same length as x that is nan
+        wherever x is nan
 
     """
+    if aligned:
+        return detrend_aligned(t, x, dt, max_gap=max_gap, recenter=recenter)
+
 
     sub_tees, sub_exes = continuous_subsets(t, x, max_gap=max_gap, repair=True)
     d_exes = [dt(sub) for sub in sub_exes]
@@ -174,6 +228,409 @@ def detrend_discontinuous_linear(t, x, max_gap=0, recenter=True):
     return c
 
 
+def detrend_aligned(t, x, func, max_gap=0, recenter=True):
+    """
+    Splits discontinuous data (and interpolates small gaps), detrends each continuous stretch and writes the results
+    into a preallocated array aligned with the input
+
+    Args:
+        t: time data (should be continuous)
+        x: x data. may be gappy (has nans)
+        func: a function that takes a continuous stretch of data and returns it detrended
+        max_gap: the largest gap allowable for interpolation
+        recenter: if True, with output will have the same mean as the input
+
+    Returns:
+        The detrended data as a np array the same length as x that is nan wherever x is nan
+
+    """
+    starts, ends = continuous_bounds(x, max_gap=max_gap)
+    x = np.asarray(x, dtype=float)
+
+    detrended = np.full(len(x), np.nan)
+    for start, end in zip(starts, ends):
+        sub = x[start:end]
+        if max_gap > 0:
+            sub = fill_gaps(t[start:end], sub)
+        detrended[start:end] = func(sub)
+
+    if recenter:
+        # the mean of the detrended stretches includes the interpolated points, as in the list based version
+        detrended += np.nanmean(x) - np.nanmean(detrended)
+    detrended[np.isnan(x)] = np.nan
+
+    return detrended
+
+
+def detrend_block(t, block, fs, T, ftype, max_gap=0, recenter=True, order=5):
+    """
+    Like detrend_discontinuous, but for several parameters of a gauge at once. The filter is designed once as
+    second-order sections, and continuous stretches of equal length from all the parameters are filtered together
+    with sosfiltfilt
+
+    Args:
+        t: time data (should be continuous)
+        block: 2D array-like of data, one column per parameter. may be gappy (has nans)
+        fs: the sampling FREQUENCY of the data
+        T: the PERIOD or PERIODS (not frequency) for the filter
+        ftype: the filtering type. 'highpass', 'lowpass', 'bandpass', 'bandstop'
+        max_gap: the largest gap allowable for interpolation
+        recenter: if True, each output column will have the same mean as the input
+        order: the filter order
+
+    Returns:
+        A tuple (detrended, errors). detrended is a 2D np array aligned with block that is nan wherever block is
+        nan. errors is a dict relating the position of each column that could not be detrended to the TypeError
+        (malformed data) or ValueError (data too gappy to detrend) raised; those columns are all nan
+
+    """
+    block = np.asarray(block)
+    if block.ndim == 1:
+        block = block.reshape(-1, 1)
+    sos = filter_design(fs, T, ftype, order=order)
+
+    detrended = np.full(block.shape, np.nan)
+    errors = {}
+    by_length = {}  # stretch length: list of (column, start, end, data)
+    for j in range(block.shape[1]):
+        try:
+            starts, ends = continuous_bounds(block[:, j], max_gap=max_gap)
+        except TypeError as e:
+            errors[j] = e
+            continue
+        col = block[:, j].astype(float)
+        for start, end in zip(starts, ends):
+            sub = col[start:end]
+            if max_gap > 0:
+                sub = fill_gaps(t[start:end], sub)
+            by_length.setdefault(end - start, []).append((j, start, end, sub))
+
+    for stretches in by_length.values():
+        try:
+            filtered = signal.sosfiltfilt(sos, np.stack([sub for j, start, end, sub in stretches]), axis=1)
+        except ValueError as e:  # too short to filter
+            errors.update({j: e for j, start, end, sub in stretches})
+            continue
+        for (j, start, end, sub), res in zip(stretches, filtered):
+            detrended[start:end, j] = res
+
+    for j in range(block.shape[1]):
+        if j in errors:
+            detrended[:, j] = np.nan
+            continue
+        col = block[:, j].astype(float)
+        if recenter:
+            # the mean of the filtered stretches includes the interpolated points, as in detrend_discontinuous
+            detrended[:, j] += np.nanmean(col) - np.nanmean(detrended[:, j])
+        detrended[np.isnan(col), j] = np.nan
+
+    return detrended, errors
+
+
+class IncrementalDetrend:
+    """
+    Detrends a growing series like detrend_discontinuous(aligned=True) without filtering its whole history on every
+    update. Continuous stretches that ended before the last one are final: they are never filtered again and are
+    bit-identical to a full run. For the last stretch, the forward filter state at its end is kept, so the forward
+    pass (which is causal) continues over the new points exactly as a full run would. The backward pass is not
+    causal, so it is re-run from the new end over the whole last stretch, and the output is bit-identical to a full
+    run.
+
+    The backward filter state is kept every checkpoint points. With tol > 0, once the new state at a checkpoint
+    more than tail points from the end agrees with the kept one to within tol, the kept output before it is reused
+    instead of re-running the backward pass over the rest of the stretch. The backward filter state never settles to
+    the last bit (rounding keeps it within ~1e-12 of a full run), so the reused output matches a full run to within
+    about tol rather than bit for bit. Only the last tail points are always re-filtered
+
+    Args:
+        fs: the sampling FREQUENCY of the data
+        T: the PERIOD or PERIODS (not frequency) for the filter
+        ftype: the filtering type. 'highpass', 'lowpass', 'bandpass', 'bandstop'
+        max_gap: the largest gap allowable for interpolation
+        recenter: if True, with output will have the same mean as the input
+        checkpoint: the spacing of the kept backward filter states. The backward pass is re-run in steps of this
+                    many points
+        tol: how closely, relative to its size, the backward filter state must match the kept state before the kept
+             output is reused. 0 only reuses output when the states are bit-identical, so the output is exact
+        tail: the number of points from the end of the series that are always re-filtered when tol > 0. Must be
+              given if tol > 0
+    """
+
+    def __init__(self, fs, T, ftype, max_gap=0, recenter=True, checkpoint=64, tol=0, tail=None):
+        if tol > 0 and tail is None:
+            raise ValueError('tail must be given when tol > 0')
+        self.settings = (fs, T, ftype, max_gap, recenter, tol, tail)
+        self.max_gap = max_gap
+        self.recenter = recenter
+        self.checkpoint = checkpoint
+        self.tol = tol
+        self.tail = 0 if tail is None else tail
+        self.b, self.a = signal.butter(5, cutoff(fs, T), ftype)
+        self.zi = signal.lfilter_zi(self.b, self.a)
+        self.padlen = 3 * max(len(self.a), len(self.b))  # the filtfilt default
+        self.refiltered = 0  # the number of points the backward pass ran over in the last update
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the series seen so far
+        """
+        self.x = np.empty(0)
+        self.raw = np.empty(0)  # detrended stretches before recentering, including interpolated points
+        self.open_start = 0  # the start of the last continuous stretch, which can still change
+        self.open_state = None  # the filter state of that stretch, see _filter
+
+    def update(self, t, x):
+        """
+        Brings the detrended series up to date. If the series seen so far is the start of x, only the new points
+        and the end of the last continuous stretch are filtered. Otherwise the whole series is
+
+        Args:
+            t: time data (should be continuous)
+            x: x data, the whole series so far. may be gappy (has nans)
+
+        Returns:
+            The detrended data as a np array the same length as x that is nan wherever x is nan
+
+        """
+        n_old = len(self.x)
+        x_raw = np.asarray(x)
+        if len(x_raw) < n_old or not np.array_equal(x_raw[:n_old], self.x, equal_nan=True):
+            self.reset()
+        open_start, open_state = self.open_start, self.open_state
+
+        # a gap longer than max_gap ends every stretch before open_start, so bounds before it can't change
+        starts, ends = continuous_bounds(x_raw[open_start:], max_gap=self.max_gap)
+        starts, ends = starts + open_start, ends + open_start
+        x = x_raw.astype(float)
+
+        raw = np.full(len(x), np.nan)
+        raw[:open_start] = self.raw[:open_start]
+        refiltered = 0
+        for start, end in zip(starts, ends):
+            sub = x[start:end]
+            if self.max_gap > 0:
+                sub = fill_gaps(t[start:end], sub)
+
+            if start == open_start and open_state is not None:
+                kept_from, filtered, state = self._filter(sub, open_state)
+                raw[start:start + kept_from] = self.raw[start:start + kept_from]
+            else:
+                kept_from, filtered, state = self._filter(sub)
+            raw[start + kept_from:end] = filtered
+            refiltered += len(filtered)
+            open_start, open_state = start, state
+
+        self.x = x
+        self.raw = raw
+        self.open_start, self.open_state = open_start, open_state
+        self.refiltered = refiltered
+
+        return self.result()
+
+    def result(self):
+        """
+        Gets the detrended series
+
+        Returns:
+            The detrended data as a np array the same length as the series that is nan wherever the series is nan
+
+        """
+        detrended = self.raw.copy()
+        if self.recenter:
+            detrended += np.nanmean(self.x) - np.nanmean(detrended)
+        detrended[np.isnan(self.x)] = np.nan
+
+        return detrended
+
+    def _filter(self, sub, old=None):
+        """
+        Runs filtfilt over a continuous stretch as signal.filtfilt does, optionally continuing from the state kept
+        from an earlier, shorter version of the same stretch
+
+        Returns:
+            a tuple (kept_from, filtered, state). Output before kept_from is unchanged from the earlier version,
+            filtered is the output from kept_from on, and state is (forward output, forward state at the end,
+            backward states, length)
+        """
+        b, a, zi, pad = self.b, self.a, self.zi, self.padlen
+        n = len(sub)
+        if n <= pad:
+            raise ValueError(f'The length of the input vector x must be greater than padlen, which is {pad}.')
+
+        # odd extension at the end, as signal.filtfilt pads
+        right = 2 * sub[-1] - sub[-2:-(pad + 2):-1]
+
+        forward = np.empty(n)
+        if old is None:
+            left = 2 * sub[0] - sub[pad:0:-1]
+            y, fwd_state = signal.lfilter(b, a, left, zi=zi * left[0])
+            resume_at = 0
+            old_bwd_states, old_n = {}, 0
+        else:
+            old_forward, fwd_state, old_bwd_states, old_n = old
+            forward[:old_n] = old_forward
+            resume_at = old_n
+        if resume_at < n:
+            forward[resume_at:], fwd_state = signal.lfilter(b, a, sub[resume_at:], zi=fwd_state)
+        y_right, end_state = signal.lfilter(b, a, right, zi=fwd_state)
+
+        filtered = np.empty(n)
+        y, state = signal.lfilter(b, a, y_right[::-1], zi=zi * y_right[-1])
+        bwd_states = dict(old_bwd_states)
+        hi = n
+        while hi > 0:
+            lo = ((hi - 1) // self.checkpoint) * self.checkpoint
+            y, state = signal.lfilter(b, a, forward[lo:hi][::-1], zi=state)
+            filtered[lo:hi] = y[::-1]
+            if lo in old_bwd_states and lo < old_n and lo <= n - self.tail:
+                kept = old_bwd_states[lo]
+                if np.max(np.abs(state - kept)) <= self.tol * np.max(np.abs(kept)):
+                    break  # the rest of the backward pass would (nearly) repeat the earlier one
+            bwd_states[lo] = state
+            hi = lo
+
+        return lo, filtered[lo:], (forward, fwd_state, bwd_states, n)
+
+
+def incremental_detrend(state_file, t, x, fs, T, ftype, max_gap=0, recenter=True):
+    """
+    Like detrend_discontinuous(aligned=True), but keeps an IncrementalDetrend for the series in a pickle file so
+    that later runs with appended data only filter what changed
+
+    Args:
+        state_file: path to the pickle file. Will be created if it doesn't exist
+        t: time data (should be continuous)
+        x: x data. may be gappy (has nans)
+        fs: the sampling FREQUENCY of the data
+        T: the PERIOD or PERIODS (not frequency) for the filter
+        ftype: the filtering type. 'highpass', 'lowpass', 'bandpass', 'bandstop'
+        max_gap: the largest gap allowable for interpolation
+        recenter: if True, with output will have the same mean as the input
+
+    Returns:
+        The detrended data as a np array the same length as x that is nan wherever x is nan
+
+    """
+    inc = None
+    if os.path.exists(state_file):
+        with open(state_file, 'rb') as f:
+            inc = pickle.load(f)
+        if inc.settings != (fs, T, ftype, max_gap, recenter, 0, None):
+            inc = None
+    if inc is None:
+        inc = IncrementalDetrend(fs, T, ftype, max_gap=max_gap, recenter=recenter)
+
+    detrended = inc.update(t, x)
+
+    with open(state_file, 'wb') as f:
+        pickle.dump(inc, f)
+
+    return detrended
+
+
+def detrend_climatology(dates, x, smooth=31, recenter=True):
+    """
+    Removes the seasonal cycle by subtracting a smoothed day-of-year mean. The data is laid out as a years x days
+    matrix, so gaps need no interpolation or splitting: they simply add nothing to the mean for their days
+
+    Args:
+        dates: the date of each point
+        x: x data. may be gappy (has nans)
+        smooth: the width in days of the circular moving average applied to the day-of-year means
+        recenter: if True, with output will have the same mean as the input
+
+    Returns:
+        The detrended data as a np array the same length as x that is nan wherever x is nan
+
+    """
+    dates = pd.DatetimeIndex(dates)
+    np.isnan(np.asarray(x))  # raises a TypeError for malformed (non-numeric) data, as continuous_bounds does
+    x = np.asarray(x, dtype=float)
+
+    # day of year on a 365 day calendar; Feb 29 shares a day with Feb 28
+    leap_shift = (dates.is_leap_year & (dates.month > 2)).astype(int)
+    doy = np.asarray(dates.dayofyear - leap_shift - 1)
+    doy[(dates.month == 2) & (dates.day == 29)] = 58
+    year = np.asarray(dates.year - dates.year.min())
+
+    valid = ~np.isnan(x)
+    flat = year * 365 + doy
+    n_years = year.max() + 1 if len(year) else 0
+    sums = np.bincount(flat[valid], weights=x[valid], minlength=n_years * 365).reshape(n_years, 365)
+    counts = np.bincount(flat[valid], minlength=n_years * 365).reshape(n_years, 365)
+
+    day_sums = sums.sum(axis=0)
+    day_counts = counts.sum(axis=0)
+    # circular moving average of the daily means, weighted by how many points each day has
+    half = smooth // 2
+    kernel = np.ones(smooth)
+    wrapped_sums = np.concatenate((day_sums[-half:], day_sums, day_sums[:smooth - half - 1]))
+    wrapped_counts = np.concatenate((day_counts[-half:], day_counts, day_counts[:smooth - half - 1]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        climatology = np.convolve(wrapped_sums, kernel, 'valid') / np.convolve(wrapped_counts, kernel, 'valid')
+
+    detrended = x - climatology[doy]
+    if recenter:
+        detrended += np.nanmean(x) - np.nanmean(detrended)
+
+    return detrended
+
+
+def detrend_by_method(t, x, method, max_gap=0, linear_gap=365, state_file=None, dates=None):
+    """
+    Detrends a parameter with one of the methods used in processing.py
+
+    Args:
+        t: time data (should be continuous)
+        x: x data. may be gappy (has nans)
+        method: None for no detrending, 'lin' to remove the linear signal, 'clim' to remove the seasonal
+                climatology, or the maximum allowable period for sinusoidal signals, which are removed with a
+                highpass filter
+        max_gap: the largest gap allowable for interpolation when removing sinusoidal signals
+        linear_gap: the largest gap allowable for interpolation when removing the linear signal
+        state_file: optional pickle file for incremental_detrend, used when removing sinusoidal signals
+        dates: the date of each point. Needed for 'clim'
+
+    Returns:
+        The detrended data as a np array the same length as x that is nan wherever x is nan
+
+    """
+    if method is None:
+        return np.asarray(x)
+    elif method == 'clim':
+        return detrend_climatology(dates, x)
+    elif method != 'lin':
+        if state_file is None:
+            return detrend_discontinuous(t, x, 1, method, 'high', max_gap=max_gap, aligned=True)
+        else:
+            return incremental_detrend(state_file, t, x, 1, method, 'high', max_gap=max_gap)
+    else:
+        return detrend_discontinuous_linear(t, x, max_gap=linear_gap, aligned=True)
+
+
+def detrend_job(t, x, method, max_gap=0, linear_gap=365, state_file=None, dates=None):
+    """
+    Runs detrend_by_method, returning rather than raising the errors that mark malformed or overly gappy data so that
+    it can be run in a worker process
+
+    Args:
+        see detrend_by_method
+
+    Returns:
+        a tuple (detrended, error), where error is None, 'TypeError' (malformed data) or 'ValueError' (data too
+        gappy to detrend). detrended is None if there was an error
+
+    """
+    try:
+        return detrend_by_method(t, x, method, max_gap=max_gap, linear_gap=linear_gap, state_file=state_file,
+                                 dates=dates), None
+    except TypeError:
+        return None, 'TypeError'
+    except ValueError:
+        return None, 'ValueError'
+
+
 def crush_series(original_index, original, to_crush_index, to_crush):
     """
     Removes all values in to_crush that are nan in the original
@@ -4,6 +4,7 @@ For detrending gauge data and adding rain data to the detrended data
 
 import os
 import shutil
+from concurrent.futures import ProcessPoolExecutor
 
 from read import clean_read
 from detrend import *
@@ -26,7 +27,8 @@ detr_meth = {'PH': None,
              'DO': 28,
              'N in situ': None,
              'SS': None
-             }  # detrending method: 'linear',  maximum allowable period for sinusoidal signals, or None
+             }  # detrending method: 'lin' (linear), 'clim' (smoothed day-of-year climatology), maximum allowable
+# period for sinusoidal signals, or None
 
 gauge_file = r'E:\hurricane\station_coords.csv'
 # csv that gives that latitude and longitude of each gauge
@@ -34,6 +36,15 @@ gauge_file = r'E:\hurricane\station_coords.csv'
 maxg = 56  # max detrending gap in days. if there are over maxg days of no data, then the time series will be
 # split at that point and each segment will be detrended separately
 
+n_workers = 1
+# number of worker processes for detrending. each gauge and parameter is detrended independently, so this can be up to
+# the number of cores. 1 detrends serially in this process
+
+detrend_state_loc = None
+# folder where the filter state of each gauge and parameter is kept between runs, e.g. r'E:\hurricane\detrend_state'.
+# if set, sinusoidal detrending only re-filters the end of a record that has had data appended since the last run.
+# None detrends every record in full. Should not be inside out_loc, which is deleted on every run
+
 sf = r'E:\hurricane\dates\hurricane_data_dates.txt'
 # "storm files'
 # path to a txt file with tabular data formatted as HURRICANE,LANDFALL,DATASTART,DATAEND
@@ -44,91 +55,169 @@ sef = r'E:\hurricane\station_nos'
 
 parent = r'E:\hurricane\prism'
 # folder where prism rain data is stores
+prism_zipped = False
+# if True, the prism rasters are read straight from the .zip archives they are distributed in, which are in the
+# subfolders of parent. if False, the archives must already be unzipped there
+prism_pad = None
+# if a number of days, only prism rasters within that many days of a storm's DATASTART to DATAEND window in sf are
+# read, and rain is nan outside the windows. None reads every raster in parent
+prism_mmap = True
+# if True, the prism .bil rasters are memory mapped using their .hdr files and only the gauge pixels are read.
+# if False, each raster is read in full with GDAL
+prism_workers = 1
+# number of prism rasters to read concurrently
+prism_processes = False
+# if True, prism_workers are processes rather than threads
+basin_file = None
+# GeoJSON or shapefile of the basin polygon of each gauge, with the gauge number in a 'gauge' field, e.g.
+# r'E:\hurricane\basins.geojson'. if set, rain is averaged over each gauge's basin instead of read at the gauge
+basin_radius = None
+# radius in km of the area rain is averaged over for gauges that have no basin polygon. None reads rain at the gauge
+prism_store = None
+# folder of a store written by repack.py, e.g. r'E:\hurricane\prism_store'. if set, rain is read from the store
+# instead of from the rasters in parent, and prism_pad, prism_zipped and rain_cube_loc are unused
+rain_cube_loc = None
+# folder where the rain extracted for each gauge and day is kept between runs, e.g. r'E:\hurricane\rain_cube'.
+# if set, only rasters and gauges that are new since the last run are extracted. None extracts everything on every run.
+# Should not be inside out_loc, which is deleted on every run
 
 ###############################
 
-if os.path.isdir(out_loc):
-    shutil.rmtree(out_loc)
-
-if os.path.exists(detrend_note_loc):
-    os.remove(detrend_note_loc)
-
-os.mkdir(out_loc)
-pd.Series(detr_meth).to_csv(detrend_note_loc)
-
-gauge_dates = relate_gauges_to_storms(sf, sef)
-gauges = list(gauge_dates.keys())
-gauge_files = [os.path.join(stations_parent, gauge + '.csv') for gauge in gauges]
-print('Reading station data in')
 
-station_dfs = {gauge: clean_read(file) for gauge, file in zip(gauges, gauge_files)}
-# modded_gauge_dates = onsets_by_rain(gauge_dates,station_dfs)
-
-# custom mods
-# gauge = '02160700' # chop at index 4293 for PH
-station_dfs['02160700']['PH'].loc[:4293] = np.nan
-
-# detrending
-val_err, type_err = [], []
-n = len(station_dfs)
-out_par = [p + ' Detrend' for p in params]
-for par, out_p in zip(params, out_par):
-    print(f'\n--------- Detrending {par} ---------\n')
-    for i, (gauge, df) in enumerate(station_dfs.items()):
-        print(f'On {i + 1} of {n}')
-        try:
-            if detr_meth[par] is None:
-                dt = df[par]
-            elif detr_meth[par] != 'lin':
-                t_max = detr_meth[par]
-                dt = detrend_discontinuous(df.index, df[par], 1, t_max, 'high', max_gap=maxg)
+def job_args(df, gauge, par):
+    """
+    Gets the arguments to detrend_job for a parameter of a gauge. Only the index and the one column are included so
+    that little data is sent to worker processes
+
+    Args:
+        df: the gauge's df
+        gauge: the gauge number
+        par: the parameter
+
+    Returns:
+        a tuple of arguments
+
+    """
+    if detrend_state_loc is not None:
+        state_file = os.path.join(detrend_state_loc, f'{gauge}_{par}.pkl')
+    else:
+        state_file = None
+    if detr_meth[par] == 'clim':
+        dates = df['Date'].to_numpy()
+    else:
+        dates = None
+    return np.asarray(df.index), df[par].to_numpy(), detr_meth[par], maxg, 365, state_file, dates
+
+
+if __name__ == '__main__':
+    if os.path.isdir(out_loc):
+        shutil.rmtree(out_loc)
+
+    if os.path.exists(detrend_note_loc):
+        os.remove(detrend_note_loc)
+
+    os.mkdir(out_loc)
+    if detrend_state_loc is not None and not os.path.isdir(detrend_state_loc):
+        os.mkdir(detrend_state_loc)
+    pd.Series(detr_meth).to_csv(detrend_note_loc)
+
+    gauge_dates = relate_gauges_to_storms(sf, sef)
+    gauges = list(gauge_dates.keys())
+    gauge_files = [os.path.join(stations_parent, gauge + '.csv') for gauge in gauges]
+    print('Reading station data in')
+
+    station_dfs = {gauge: clean_read(file) for gauge, file in zip(gauges, gauge_files)}
+    # modded_gauge_dates = onsets_by_rain(gauge_dates,station_dfs)
+
+    # custom mods
+    # gauge = '02160700' # chop at index 4293 for PH
+    station_dfs['02160700']['PH'].loc[:4293] = np.nan
+
+    # detrending
+    val_err, type_err = [], []
+    n = len(station_dfs)
+    out_par = [p + ' Detrend' for p in params]
+
+    if n_workers > 1:
+        pool = ProcessPoolExecutor(max_workers=n_workers)
+        jobs = {(par, gauge): pool.submit(detrend_job, *job_args(station_dfs[gauge], gauge, par))
+                for par in params for gauge in station_dfs}
+
+    for par, out_p in zip(params, out_par):
+        print(f'\n--------- Detrending {par} ---------\n')
+        for i, gauge in enumerate(station_dfs):
+            print(f'On {i + 1} of {n}')
+            if n_workers > 1:
+                dt, err = jobs[(par, gauge)].result()
             else:
-                dt = detrend_discontinuous_linear(df.index, df[par], max_gap=365)
-            station_dfs[gauge][out_p] = dt
-        except TypeError:  # malformed data
-            print(f'TypeError on {gauge}')
-            station_dfs[gauge][out_p] = np.nan
-            type_err.append(gauge)
-        except ValueError:  # data too gappy to detrend
-            print(f'ValueError on {gauge}')
-            station_dfs[gauge][out_p] = np.nan
-            val_err.append(gauge)
-
-# adding PRISM rain data
-
-
-bils = get_bils(parent)
-
-col_names = pd.read_csv(gauge_file, nrows=0).columns
-types_dict = {'gauge': str, 'x': float, 'y':float}
-
-gauges = pd.read_csv(gauge_file, dtype=types_dict)
-
-
-dates, rows = extract_timeseries(gauges.x, gauges.y, bils)
-
-rain_df = unpack_timeseries(gauges.gauge,dates,rows)
-station_dfs = {station:df.set_index('Date') for station, df in station_dfs.items()}
-print('Joining rain data')
-for gauge_no, gauge_df in station_dfs.items():
-    print(f'On {gauge_no}')
-    try:
-        rain = rain_df[gauge_no]
-        rain.name = 'Rain'
-        new = pd.merge(gauge_df, rain, how='left', left_index=True, right_index=True)
-        station_dfs[gauge_no] = new
-        print(f'success on {gauge_no}')
-    except KeyError:
-        station_dfs[gauge_no]['Rain'] = np.nan
-        print(f'no rain data for {gauge_no}')
-        pass
-
-station_dfs = {station:df.reset_index(level='Date') for station, df in station_dfs.items()}
-
-# writing
-
-n = len(station_dfs)
-for i, (gauge, df) in enumerate(station_dfs.items()):
-    print(f'Writing {gauge}. {i + 1} of {n}')
-    out_name = os.path.join(out_loc, f'{gauge}.csv')
-    df.to_csv(out_name, index=False)
+                dt, err = detrend_job(*job_args(station_dfs[gauge], gauge, par))
+
+            if err is None:
+                station_dfs[gauge][out_p] = dt
+            elif err == 'TypeError':  # malformed data
+                print(f'TypeError on {gauge}')
+                station_dfs[gauge][out_p] = np.nan
+                type_err.append(gauge)
+            else:  # data too gappy to detrend
+                print(f'ValueError on {gauge}')
+                station_dfs[gauge][out_p] = np.nan
+                val_err.append(gauge)
+
+    if n_workers > 1:
+        pool.shutdown()
+
+    # adding PRISM rain data
+
+
+    if prism_store is not None:
+        bils = None
+    elif prism_pad is None:
+        bils = get_bils(parent, zipped=prism_zipped)
+    else:
+        bils = get_bils(parent, windows=storm_windows(sf), pad=prism_pad, zipped=prism_zipped)
+
+    col_names = pd.read_csv(gauge_file, nrows=0).columns
+    types_dict = {'gauge': str, 'x': float, 'y':float}
+
+    gauges = pd.read_csv(gauge_file, dtype=types_dict)
+
+
+    polygons = None
+    if basin_file is not None:
+        basins = read_basins(basin_file)
+        polygons = [basins.get(gauge) for gauge in gauges.gauge]
+
+    if prism_store is not None:
+        dates, rows = extract_timeseries(gauges.x, gauges.y, None, polygons=polygons, radius=basin_radius,
+                                         store=prism_store)
+        rain_df = unpack_timeseries(gauges.gauge,dates,rows)
+    elif rain_cube_loc is None:
+        dates, rows = extract_timeseries(gauges.x, gauges.y, bils, mmap=prism_mmap, workers=prism_workers,
+                                         processes=prism_processes, polygons=polygons, radius=basin_radius)
+        rain_df = unpack_timeseries(gauges.gauge,dates,rows)
+    else:
+        cube_index, cube = update_rain_cube(rain_cube_loc, gauges.gauge, gauges.x, gauges.y, bils, mmap=prism_mmap,
+                                            workers=prism_workers, processes=prism_processes, polygons=polygons,
+                                            radius=basin_radius)
+        rain_df = unpack_timeseries(cube_index['gauges'], pd.to_datetime(cube_index['dates']), cube)
+    rain_dates = rain_df.index.values
+    rain_vals = rain_df.to_numpy()
+    sorter = np.argsort(rain_dates, kind='stable')
+    print('Joining rain data')
+    for gauge_no, gauge_df in station_dfs.items():
+        print(f'On {gauge_no}')
+        if gauge_no in rain_df.columns:
+            col = rain_df.columns.get_loc(gauge_no)
+            gauge_df['Rain'] = rain_at_dates(rain_dates, rain_vals[:, col], gauge_df['Date'].values, sorter=sorter)
+            print(f'success on {gauge_no}')
+        else:
+            gauge_df['Rain'] = np.nan
+            print(f'no rain data for {gauge_no}')
+
+    # writing
+
+    n = len(station_dfs)
+    for i, (gauge, df) in enumerate(station_dfs.items()):
+        print(f'Writing {gauge}. {i + 1} of {n}')
+        out_name = os.path.join(out_loc, f'{gauge}.csv')
+        df.to_csv(out_name, index=False)
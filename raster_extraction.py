@@ -3,13 +3,22 @@ Functions to help with extracting rain gauge data from .bils format raster files
 """
 
 import os
-from datetime import datetime
+import json
+import hashlib
+import zipfile
+from datetime import datetime, timedelta
+from bisect import bisect_right
 import time
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import gdal
+import ogr
 import pandas as pd
 import numpy as np
+from scipy import sparse
 import matplotlib.pyplot as plt
+from matplotlib.path import Path
 
 from read import clean_read
 
@@ -73,7 +82,199 @@ def value_at_coords(file, x_coords, y_coords):
     return vals
 
 
-def date_and_vals(file, x_coords, y_coords):
+def split_zip_path(file):
+    """
+    Splits a GDAL /vsizip/ path, e.g. /vsizip/E:/prism/PRISM_ppt_stable_4kmD2_19980101_bil.zip/PRISM_ppt_stable_4kmD2_
+    19980101_bil.bil, into the zip archive and the member within it
+
+    Args:
+        file: filepath
+
+    Returns:
+        a tuple (archive path, member name), or None if file is not a /vsizip/ path
+
+    """
+    if not file.startswith('/vsizip/'):
+        return None
+    end = file.lower().index('.zip') + 4
+    return file[len('/vsizip/'):end], file[end+1:].replace('\\', '/')
+
+
+def read_bil_header(file):
+    """
+    Reads the .hdr sidecar of a .bil raster
+
+    Args:
+        file: filepath of the .bil
+
+    Returns:
+        a dict relating each (uppercase) header key to its value, as a float where possible
+
+    """
+    hdr = os.path.splitext(file)[0] + '.hdr'
+    zipped = split_zip_path(hdr)
+    if zipped is None:
+        with open(hdr) as f:
+            lines = f.readlines()
+    else:
+        with zipfile.ZipFile(zipped[0]) as archive:
+            lines = archive.read(zipped[1]).decode().splitlines()
+
+    header = {}
+    for line in lines:
+        parts = line.split()
+        if len(parts) < 2:
+            continue
+        try:
+            header[parts[0].upper()] = float(parts[1])
+        except ValueError:
+            header[parts[0].upper()] = parts[1].upper()
+    return header
+
+
+def bil_pixels(header, x_coords, y_coords):
+    """
+    Finds the pixels of a .bil raster that coordinates fall within, as value_at_coords does
+
+    Args:
+        header: output of read_bil_header
+        x_coords: x coords list of floats
+        y_coords: y coords list of floats
+
+    Returns:
+        a tuple of np arrays (rows, cols)
+
+    """
+    # ULXMAP/ULYMAP are the center of the upper left pixel; GDAL's origin is its corner
+    pixel_width = header['XDIM']
+    pixel_height = header['YDIM']
+    x_origin = header['ULXMAP'] - pixel_width/2
+    y_origin = header['ULYMAP'] + pixel_height/2
+
+    cols = np.trunc((np.asarray(x_coords, dtype=float) - x_origin) / pixel_width).astype(int)
+    rows = np.trunc((y_origin - np.asarray(y_coords, dtype=float)) / pixel_height).astype(int)
+
+    return rows, cols
+
+
+def bil_memmap(file, header):
+    """
+    Memory maps the first band of a .bil raster without reading it
+
+    Args:
+        file: filepath
+        header: output of read_bil_header
+
+    Returns:
+        a read-only np.memmap of shape (rows, cols)
+
+    """
+    n_rows, n_cols = int(header['NROWS']), int(header['NCOLS'])
+    n_bands = int(header.get('NBANDS', 1))
+    data = np.memmap(file, dtype=bil_dtype(header), mode='r', offset=int(header.get('SKIPBYTES', 0)),
+                     shape=(n_rows, n_bands, n_cols))
+    return data[:, 0, :]
+
+
+def bil_dtype(header):
+    """
+    Gets the numpy dtype of the pixels of a .bil raster
+
+    Args:
+        header: output of read_bil_header
+
+    Returns:
+        a np.dtype
+
+    """
+    n_bits = int(header.get('NBITS', 8))
+    pixel_type = header.get('PIXELTYPE', 'UNSIGNEDINT')
+    if pixel_type == 'FLOAT':
+        kind = 'f'
+    elif pixel_type == 'SIGNEDINT':
+        kind = 'i'
+    else:
+        kind = 'u'
+    order = '>' if header.get('BYTEORDER', 'I') == 'M' else '<'
+    return np.dtype(f'{order}{kind}{n_bits // 8}')
+
+
+def zipped_bil_rows(file, header, n_rows):
+    """
+    Reads the first rows of the first band of a .bil raster that is a member of a zip archive. The member is
+    decompressed as a stream that stops after the last row needed. Each call opens its own handle on the archive, so
+    members can be read concurrently
+
+    Args:
+        file: /vsizip/ path of the .bil
+        header: output of read_bil_header
+        n_rows: number of rows to read
+
+    Returns:
+        a np array of shape (n_rows, cols)
+
+    """
+    archive_path, member = split_zip_path(file)
+    n_cols = int(header['NCOLS'])
+    n_bands = int(header.get('NBANDS', 1))
+    dtype = bil_dtype(header)
+    skip = int(header.get('SKIPBYTES', 0))
+
+    with zipfile.ZipFile(archive_path) as archive:
+        with archive.open(member) as f:
+            raw = f.read(skip + n_rows*n_bands*n_cols*dtype.itemsize)
+    data = np.frombuffer(raw, dtype=dtype, offset=skip).reshape(n_rows, n_bands, n_cols)
+    return data[:, 0, :]
+
+
+def read_bil(file, header):
+    """
+    Reads the first band of a .bil raster in full
+
+    Args:
+        file: filepath or /vsizip/ path
+        header: output of read_bil_header
+
+    Returns:
+        a np array of shape (rows, cols)
+
+    """
+    if split_zip_path(file) is None:
+        data = bil_memmap(file, header)
+        vals = np.array(data)
+        del data
+        return vals
+    return zipped_bil_rows(file, header, int(header['NROWS']))
+
+
+def values_at_pixels(file, rows, cols, header=None):
+    """
+    Returns the values of a .bil raster at a set of pixels, reading only those pixels from disk. Rasters inside zip
+    archives are read up to the last row needed instead
+
+    Args:
+        file: filepath or /vsizip/ path
+        rows: pixel rows, e.g. from bil_pixels
+        cols: pixel cols, e.g. from bil_pixels
+        header: output of read_bil_header. Read from the file's .hdr if not passed
+
+    Returns:
+        np array of the values at the pixels
+
+    """
+    if header is None:
+        header = read_bil_header(file)
+    if split_zip_path(file) is None:
+        data = bil_memmap(file, header)
+    else:
+        data = zipped_bil_rows(file, header, int(np.max(rows)) + 1)
+    vals = np.array(data[rows, cols])
+    del data
+
+    return vals
+
+
+def date_and_vals(file, x_coords, y_coords, pixels=None):
     """
     Returns the date and value of a prism raster at a given coordinate
 
@@ -81,41 +282,281 @@ def date_and_vals(file, x_coords, y_coords):
         file: filepath
         x_coord: x coord as float
         y_coord: y coord as float
+        pixels: optional (header, rows, cols) of the coordinates from read_bil_header and bil_pixels. If passed,
+                the raster is memory mapped and only those pixels are read instead of opening it with GDAL.
+                All rasters sharing the header's grid can use the same pixels
 
     Returns:
         tuple, (date, list of values at the coordinate)
 
     """
 
-    val = value_at_coords(file, x_coords, y_coords)
+    if pixels is None:
+        val = value_at_coords(file, x_coords, y_coords)
+    else:
+        header, rows, cols = pixels
+        val = values_at_pixels(file, rows, cols, header=header)
     date = date_from_prism_file(file)
 
     return date,val
 
 
-def get_bils(parent):
+def read_basins(file, id_field='gauge'):
+    """
+    Reads the basin polygons of gauges from a GeoJSON or shapefile (or anything else OGR can open). Must be in the same
+    projection as the rasters
+
+    Args:
+        file: filepath
+        id_field: the attribute that holds each polygon's gauge name
+
+    Returns:
+        a dict relating each gauge name to a tuple of lists of (n, 2) np arrays, (exterior rings, holes)
+
+    """
+    if os.path.splitext(file)[1].lower() in ('.geojson', '.json'):
+        with open(file) as f:
+            features = [(feature['properties'][id_field], feature['geometry']) for feature in json.load(f)['features']]
+    else:
+        source = ogr.Open(file)
+        layer = source.GetLayer()
+        features = [(feature.GetField(id_field), json.loads(feature.GetGeometryRef().ExportToJson()))
+                    for feature in layer]
+        source = None
+
+    basins = {}
+    for name, geometry in features:
+        if geometry['type'] == 'Polygon':
+            polygons = [geometry['coordinates']]
+        elif geometry['type'] == 'MultiPolygon':
+            polygons = geometry['coordinates']
+        else:
+            continue
+        exteriors, holes = basins.setdefault(str(name), ([], []))
+        for rings in polygons:
+            exteriors.append(np.asarray(rings[0], dtype=float)[:, :2])
+            holes.extend(np.asarray(ring, dtype=float)[:, :2] for ring in rings[1:])
+
+    return basins
+
+
+def basin_weights(header, x_coords, y_coords, polygons=None, radius=None):
+    """
+    Precomputes the weights that average a raster over the area around each gauge. A pixel is in a gauge's area if
+    its center is in the gauge's polygon, or else within radius of the gauge. Pixels are weighted by their area, which
+    shrinks with latitude. A gauge whose area holds no pixel centers gets the pixel it falls within
+
+    Args:
+        header: output of read_bil_header
+        x_coords: x coords of the gauges, in degrees
+        y_coords: y coords of the gauges, in degrees
+        polygons: optional list with an entry for each gauge that is either None or a tuple of (exterior rings,
+                  holes), e.g. from read_basins
+        radius: optional radius in km of the area around gauges without a polygon
+
+    Returns:
+        a tuple (weights, rows, cols) where weights is a sparse (gauges x pixels) matrix whose rows sum to 1 and rows
+        and cols are the pixels it refers to, in column order
+
+    """
+    n_rows, n_cols = int(header['NROWS']), int(header['NCOLS'])
+    x_dim, y_dim = header['XDIM'], header['YDIM']
+    point_rows, point_cols = bil_pixels(header, x_coords, y_coords)
+    km_per_degree = 111.195
+
+    gauge_ind, flat_ind, weights = [], [], []
+    for i, (x, y) in enumerate(zip(x_coords, y_coords)):
+        polygon = None if polygons is None else polygons[i]
+        if polygon is not None:
+            exteriors, holes = polygon
+            points = np.vstack(exteriors)
+            x_min, y_min = points.min(axis=0)
+            x_max, y_max = points.max(axis=0)
+        elif radius is not None:
+            x_reach = radius / (km_per_degree * np.cos(np.radians(y)))
+            y_reach = radius / km_per_degree
+            x_min, x_max, y_min, y_max = x - x_reach, x + x_reach, y - y_reach, y + y_reach
+        else:
+            x_min = x_max = y_min = y_max = None
+
+        inside = np.zeros(0, dtype=bool)
+        if x_min is not None:
+            # the pixels whose centers fall within the area's bounding box
+            col_lo = max(int(np.ceil((x_min - header['ULXMAP']) / x_dim)), 0)
+            col_hi = min(int(np.floor((x_max - header['ULXMAP']) / x_dim)), n_cols - 1)
+            row_lo = max(int(np.ceil((header['ULYMAP'] - y_max) / y_dim)), 0)
+            row_hi = min(int(np.floor((header['ULYMAP'] - y_min) / y_dim)), n_rows - 1)
+            box_rows, box_cols = np.mgrid[row_lo:row_hi + 1, col_lo:col_hi + 1]
+            box_rows, box_cols = box_rows.ravel(), box_cols.ravel()
+            centers = np.column_stack([header['ULXMAP'] + box_cols*x_dim, header['ULYMAP'] - box_rows*y_dim])
+
+            if polygon is not None:
+                inside = np.zeros(len(centers), dtype=bool)
+                for ring in exteriors:
+                    inside |= Path(ring).contains_points(centers)
+                for ring in holes:
+                    inside &= ~Path(ring).contains_points(centers)
+            else:
+                dx = (centers[:, 0] - x) * km_per_degree * np.cos(np.radians(y))
+                dy = (centers[:, 1] - y) * km_per_degree
+                inside = dx**2 + dy**2 <= radius**2
+
+        if inside.any():
+            rows, cols = box_rows[inside], box_cols[inside]
+            area = np.cos(np.radians(header['ULYMAP'] - rows*y_dim))
+        else:
+            rows, cols = point_rows[i:i+1], point_cols[i:i+1]
+            area = np.ones(1)
+
+        gauge_ind.append(np.full(len(rows), i))
+        flat_ind.append(rows*n_cols + cols)
+        weights.append(area / area.sum())
+
+    flat_ind = np.concatenate(flat_ind)
+    pixels, col_ind = np.unique(flat_ind, return_inverse=True)
+    weights = sparse.csr_matrix((np.concatenate(weights), (np.concatenate(gauge_ind), col_ind)),
+                                shape=(len(x_coords), len(pixels)))
+
+    return weights, pixels // n_cols, pixels % n_cols
+
+
+def basin_values(file, header, basins):
+    """
+    Averages a raster over the area around each gauge. Only the pixels the areas cover are read, and nodata pixels
+    are left out of the averages
+
+    Args:
+        file: filepath or /vsizip/ path
+        header: output of read_bil_header
+        basins: output of basin_weights
+
+    Returns:
+        np array of the average value in each gauge's area. nan if the whole area is nodata
+
+    """
+    weights, rows, cols = basins
+    return basin_average(weights, values_at_pixels(file, rows, cols, header=header), header)
+
+
+def basin_average(weights, vals, header):
+    """
+    Applies basin weights to pixel values, leaving nodata pixels out of the averages
+
+    Args:
+        weights: the sparse weight matrix from basin_weights
+        vals: np array of the values of the pixels the weights refer to, either 1d or 2d (times x pixels)
+        header: output of read_bil_header
+
+    Returns:
+        np array of the average value in each gauge's area, with a leading time axis if vals has one. nan if the whole
+        area is nodata
+
+    """
+    vals = np.asarray(vals, dtype=float)
+    valid = np.isfinite(vals)
+    if 'NODATA' in header:
+        valid &= vals != header['NODATA']
+
+    total = (weights @ np.where(valid, vals, 0).T).T
+    covered = (weights @ valid.astype(float).T).T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(covered > 0, total / covered, np.nan)
+
+
+def get_bils(parent, windows=None, pad=0, zipped=False):
     """
     Gets all .bil files in a parent directory's subdirectories
 
     Args:
         parent: parent directory
+        windows: a list of (start, end) datetime pairs, such as the storm windows from storm_windows. if given, only
+                 rasters whose date falls within one of the windows are returned. None returns every raster
+        pad: number of days to widen each window by on both sides
+        zipped: if True, the .bil files inside the .zip archives in the subdirectories are returned as /vsizip/ paths
+                instead, so that the archives do not need to be unzipped
 
     Returns:
         list of file filepaths to all .bil files
 
     """
+    if windows is not None:
+        # merged so that each date can be checked against the one window that starts before it
+        merged = []
+        for start, end in sorted((start - timedelta(days=pad), end + timedelta(days=pad)) for start, end in windows):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        starts = [window[0] for window in merged]
+
+    def in_windows(name):
+        if windows is None:
+            return True
+        date = date_from_prism_file(name)
+        i = bisect_right(starts, date) - 1
+        return i >= 0 and date <= merged[i][1]
+
     files = []
-    subs = os.listdir(parent)
-    for sub in subs:
-        sub_path = os.path.join(parent,sub)
-        all_files = os.listdir(sub_path)
-        bils = [file for file in all_files if file[-4:] == '.bil']
-        full_bils = [os.path.join(parent, sub, file) for file in bils]
-        files.extend(full_bils)
+    with os.scandir(parent) as subs:
+        for sub in subs:
+            if not sub.is_dir():
+                continue
+            with os.scandir(sub.path) as entries:
+                for entry in entries:
+                    if zipped and entry.name.endswith('.zip'):
+                        try:
+                            # daily archives are named after their day, so most never need to be opened
+                            if not in_windows(entry.name):
+                                continue
+                        except ValueError:  # not named after a day, so its members are checked instead
+                            pass
+                        with zipfile.ZipFile(entry.path) as archive:
+                            members = [member for member in archive.namelist() if member.endswith('.bil')]
+                        files.extend(f'/vsizip/{entry.path}/{member}' for member in members if in_windows(member))
+                    elif not zipped and entry.name.endswith('.bil') and in_windows(entry.name):
+                        files.append(entry.path)
     return files
 
 
-def extract_timeseries(x_coords, y_coords, bils):
+def extract_file(file, x_coords, y_coords, mmap=False, pixels=None, polygons=None, radius=None, basins=None):
+    """
+    Gets the date and values at a set of coordinates for one prism raster. Used by extract_timeseries
+
+    Args:
+        file: filepath
+        x_coords: x coords
+        y_coords: y coords
+        mmap: if True, the raster is memory mapped (or streamed, if it is in a zip archive) and only the coordinates'
+              pixels are read
+        pixels: optional (header, rows, cols) from read_bil_header and bil_pixels to reuse if the raster's header
+                matches. Only used if mmap is True
+        polygons: optional polygons of the gauges' basins. if polygons or radius is given, the raster is averaged
+                  over each gauge's area instead of sampled at its pixel. See basin_weights
+        radius: optional radius in km of the area around gauges without a polygon
+        basins: optional (header, weights, rows, cols) from read_bil_header and basin_weights to reuse if the raster's
+                header matches
+
+    Returns:
+        tuple, (date, list of values at the coordinates)
+
+    """
+    if polygons is not None or radius is not None:
+        header = read_bil_header(file)
+        if basins is None or header != basins[0]:
+            basins = (header, *basin_weights(header, x_coords, y_coords, polygons=polygons, radius=radius))
+        return date_from_prism_file(file), basin_values(file, header, basins[1:])
+
+    if mmap:
+        header = read_bil_header(file)
+        if pixels is None or header != pixels[0]:
+            pixels = (header, *bil_pixels(header, x_coords, y_coords))
+    else:
+        pixels = None
+    return date_and_vals(file, x_coords, y_coords, pixels=pixels)
+
+
+def extract_timeseries(x_coords, y_coords, bils, mmap=False, workers=1, processes=False, report_every=30,
+                       polygons=None, radius=None, store=None):
     """
     Creates a time series from a list of prism .bils rasters and a coordinate pair
 
@@ -124,28 +565,77 @@ def extract_timeseries(x_coords, y_coords, bils):
         x_coord: x coords
         y_coord: y coords
         bils: list of full paths to .bil prism rasters
+        mmap: if True, the pixel of each coordinate is found once from the .hdr of the first raster and only those
+              pixels are read from each memory mapped raster. Rasters on a different grid get their own pixels
+        workers: the number of rasters to read concurrently
+        processes: if True, the workers are processes rather than threads
+        report_every: the minimum number of seconds between progress reports
+        polygons: optional list with an entry for each coordinate that is either None or the polygons of its basin,
+                  e.g. from read_basins. if polygons or radius is given, each raster is averaged over the area around
+                  each coordinate instead of sampled at its pixel. The averaging weights are found once from the first
+                  raster's .hdr, so each raster only costs a sparse matrix product over the pixels in the areas
+        radius: optional radius in km of the area around coordinates without a polygon
+        store: optional folder of a store written by repack_prism. if given, the time series are read from the store
+               instead of from bils, which can be None, and are in date order. mmap, workers and processes are unused
 
     Returns:
-        a tuple; one entry is a list of dates and the other is a list of lists of vals at a coordinate
+        a tuple; one entry is a list of dates and the other is a 2d array of vals (bils x coordinates). Both are in the
+        order of bils
 
     """
+    if store is not None:
+        return store_timeseries(store, x_coords, y_coords, polygons=polygons, radius=radius)
+
     start = time.time()
-    extracted = []
     n = len(bils)
-    for i,file in enumerate(bils):
-        intermediate1 = time.time()
-        extracted.append(date_and_vals(file, x_coords, y_coords))
-
-        intermediate2 = time.time()
-        intermediate_elap = round(intermediate2-intermediate1, 2) # in seconds
-        running_time = round(intermediate2-start, 2)/60 # in minutes
-        frac_progress = (i+1)/n
-        estimated_total_time = round(running_time*(1/frac_progress) - running_time, 2)
 
-        print(f'Processing time: {intermediate_elap} seconds. File {i+1} of {n} complete. Estimated time remaining: '
-              f'{estimated_total_time} minutes')
-    dates = [i[0] for i in extracted]
-    vals = [i[1] for i in extracted]
+    pixels = None
+    if mmap and n > 0:
+        header = read_bil_header(bils[0])
+        pixels = (header, *bil_pixels(header, x_coords, y_coords))
+    basins = None
+    if (polygons is not None or radius is not None) and n > 0:
+        header = read_bil_header(bils[0])
+        basins = (header, *basin_weights(header, x_coords, y_coords, polygons=polygons, radius=radius))
+    extract = partial(extract_file, x_coords=x_coords, y_coords=y_coords, mmap=mmap, pixels=pixels,
+                      polygons=polygons, radius=radius, basins=basins)
+
+    executor = None
+    if workers > 1:
+        if processes:
+            executor = ProcessPoolExecutor(max_workers=workers)
+            results = executor.map(extract, bils, chunksize=max(1, n // (workers*4)))
+        else:
+            executor = ThreadPoolExecutor(max_workers=workers)
+            results = executor.map(extract, bils)
+    else:
+        results = map(extract, bils)
+
+    dates = []
+    vals = None
+    last_report = start
+    for i, (date, row_vals) in enumerate(results):  # map yields in the order of bils
+        if vals is None:
+            vals = np.empty((n, len(row_vals)), dtype=np.asarray(row_vals).dtype)
+        dates.append(date)
+        vals[i] = row_vals
+
+        now = time.time()
+        if now - last_report >= report_every or i+1 == n:
+            last_report = now
+            running_time = (now-start)/60 # in minutes
+            frac_progress = (i+1)/n
+            estimated_total_time = round(running_time*(1/frac_progress) - running_time, 2)
+            # a coarse clock may not have ticked since start, so there may be no rate to report
+            rate = f' ({round((i+1)/(now-start), 1)} files/second)' if now > start else ''
+            print(f'{i+1} of {n} files complete{rate}. '
+                  f'Estimated time remaining: {estimated_total_time} minutes')
+
+    if executor is not None:
+        executor.shutdown()
+
+    if vals is None:
+        vals = np.empty((0, len(x_coords)))
 
     final = time.time()
     elap = round(final-start, 2)
@@ -161,7 +651,8 @@ def unpack_timeseries(names, dates, val_rows):
     Args:
         names: column names
         dates: list of dates
-        val_rows: list of rows of values
+        val_rows: list of rows of values, or a 2d array of values (dates x names) such as a rain cube. An array is
+                  wrapped without being copied
 
     Returns:
         a pd DataFrame
@@ -170,14 +661,358 @@ def unpack_timeseries(names, dates, val_rows):
 
     print('Unpacking...')
 
-    row_dicts = []
-    for i,(date, row_vals) in enumerate(zip(dates,val_rows)):
-        row = {name:v for name,v in zip(names,row_vals)}
-        row['date'] = date
-        row_dicts.append(row)
-    #return(row_dicts)
-    df = pd.DataFrame(row_dicts)
-    df = df.set_index('date')
+    if isinstance(val_rows, np.ndarray) and val_rows.ndim == 2:
+        vals = val_rows
+    else:
+        names = list(names)
+        vals = None
+        for i, row_vals in enumerate(val_rows):
+            if vals is None:
+                vals = np.empty((len(dates), len(names)), dtype=np.asarray(row_vals).dtype)
+            vals[i] = row_vals
+        if vals is None:
+            vals = np.empty((len(dates), len(names)))
+
+    return pd.DataFrame(vals, index=pd.Index(dates, name='date'), columns=list(names), copy=False)
+
+
+def rain_at_dates(rain_dates, rain_vals, dates, sorter=None):
+    """
+    Aligns a rain series to a set of dates by position instead of by a merge
+
+    Args:
+        rain_dates: np datetime64 array of the dates of the rain
+        rain_vals: np array of rain, in the order of rain_dates
+        dates: dates to get the rain at
+        sorter: optional np.argsort of rain_dates. needed if rain_dates are not sorted, and can be reused between
+                calls with the same rain_dates
+
+    Returns:
+        np array of the rain at each of dates, nan where there is no rain for a date. If a date has more than one rain
+        value, the first in sorted order is used
+
+    """
+    dates = np.asarray(dates, dtype=rain_dates.dtype)
+    n = len(rain_dates)
+    out = np.full(len(dates), np.nan, dtype=np.result_type(rain_vals.dtype, np.float32))
+    if n == 0:
+        return out
+
+    pos = np.searchsorted(rain_dates, dates, sorter=sorter)
+    rows = np.minimum(pos, n-1)
+    if sorter is not None:
+        rows = sorter[rows]
+    found = (pos < n) & (rain_dates[rows] == dates)
+    out[found] = rain_vals[rows[found]]
+
+    return out
+
+
+def load_rain_cube(cube_loc, mmap=True):
+    """
+    Loads a rain cube written by update_rain_cube
+
+    Args:
+        cube_loc: folder of the rain cube
+        mmap: if True, the values are memory mapped read only instead of being read into memory
+
+    Returns:
+        a tuple; one entry is the cube's index, a dict with the keys 'files' and 'dates' (one entry per row) and
+        'gauges', 'x' and 'y' (one entry per column), and the other is a 2d float32 array of values (dates x gauges).
+        Both are None if there is no cube at cube_loc
+
+    """
+    index_file = os.path.join(cube_loc, 'index.json')
+    if not os.path.exists(index_file):
+        return None, None
+
+    with open(index_file) as f:
+        index = json.load(f)
+    vals = np.load(os.path.join(cube_loc, 'cube.npy'), mmap_mode='r' if mmap else None)
+
+    return index, vals
+
+
+def area_mode(polygon=None, radius=None):
+    """
+    Describes how the rain of a gauge is extracted, so that values extracted in different ways are never mixed
+
+    Args:
+        polygon: optional polygons of the gauge's basin, as an entry of read_basins
+        radius: optional radius in km of the area around the gauge
+
+    Returns:
+        a string; 'point', 'radius:<radius>' or 'polygon:<hash of the polygon>'
+
+    """
+    if polygon is not None:
+        exteriors, holes = polygon
+        digest = hashlib.sha1()
+        for ring in exteriors:
+            digest.update(np.ascontiguousarray(ring, dtype=float).tobytes())
+        digest.update(b'holes')
+        for ring in holes:
+            digest.update(np.ascontiguousarray(ring, dtype=float).tobytes())
+        return f'polygon:{digest.hexdigest()}'
+    if radius is not None:
+        return f'radius:{float(radius)!r}'
+    return 'point'
+
+
+def update_rain_cube(cube_loc, names, x_coords, y_coords, bils, polygons=None, radius=None, **kwargs):
+    """
+    Brings a persistent rain cube up to date with a list of prism rasters and a set of gauges. Only rasters that are
+    not in the cube are extracted for every gauge, and only gauges that are not in the cube (or whose coordinates
+    or area_mode have changed) are extracted for the rasters already in it. Rasters are identified by filename, so an
+    archive can be moved without invalidating the cube. Gauges and rasters in the cube that are not passed are kept,
+    unless their area_mode can no longer be reproduced (e.g. they were basin averages and no polygon is passed for
+    them), in which case they are dropped
+
+    Args:
+        cube_loc: folder of the rain cube. will be created if it doesn't exist
+        names: gauge names
+        x_coords: x coords of the gauges
+        y_coords: y coords of the gauges
+        bils: list of full paths to .bil prism rasters
+        polygons: optional list of the polygons of each gauge's basin, as in extract_timeseries
+        radius: optional radius in km of the area around gauges without a polygon, as in extract_timeseries
+        **kwargs: passed to extract_timeseries
+
+    Returns:
+        the cube's index and its memory mapped values, as returned by load_rain_cube
+
+    """
+    names = [str(name) for name in names]
+    x_coords = np.asarray(x_coords, dtype=float)
+    y_coords = np.asarray(y_coords, dtype=float)
+    if polygons is not None:
+        polygons = dict(zip(names, polygons))
+    else:
+        polygons = {}
+    modes = [area_mode(polygons.get(name), radius) for name in names]
+
+    index, old_vals = load_rain_cube(cube_loc, mmap=True)
+    if index is None:
+        index = {'files': [], 'dates': [], 'gauges': [], 'x': [], 'y': [], 'modes': []}
+        old_vals = np.empty((0, 0), dtype=np.float32)
+    old_modes = index.get('modes', ['point'] * len(index['gauges']))  # cubes from before modes were recorded
+
+    known = {gauge: (x, y, mode) for gauge, x, y, mode in zip(index['gauges'], index['x'], index['y'], old_modes)}
+    new_gauges = [i for i, name in enumerate(names)
+                  if known.get(name) != (x_coords[i], y_coords[i], modes[i])]
+    redone = {names[i] for i in new_gauges}
+    passed = set(names)
+    keep_cols = []
+    dropped = False
+    for j, gauge in enumerate(index['gauges']):
+        if gauge in redone:
+            continue
+        if gauge not in passed and old_modes[j] != area_mode(None, radius):
+            print(f'Dropping {gauge} from the rain cube. It was extracted as {old_modes[j]}, which cannot be repeated')
+            dropped = True
+            continue
+        keep_cols.append(j)
+
+    done = set(index['files'])
+    new_bils = [bil for bil in bils if os.path.basename(bil) not in done]
+
+    if not new_gauges and not new_bils and not dropped:
+        print('Rain cube is up to date')
+        return index, old_vals
+
+    gauges = [index['gauges'][j] for j in keep_cols] + [names[i] for i in new_gauges]
+    xs = np.append(np.asarray(index['x'], dtype=float)[keep_cols], x_coords[new_gauges])
+    ys = np.append(np.asarray(index['y'], dtype=float)[keep_cols], y_coords[new_gauges])
+    gauge_modes = [old_modes[j] for j in keep_cols] + [modes[i] for i in new_gauges]
+
+    # the new gauges over the rasters already in the cube. rasters that have since left the archive are left as nan
+    old_new = np.full((len(index['files']), len(new_gauges)), np.nan, dtype=np.float32)
+    if new_gauges and index['files']:
+        paths = {os.path.basename(bil): bil for bil in bils}
+        found = [i for i, file in enumerate(index['files']) if file in paths]
+        print(f'Extracting {len(new_gauges)} new gauges from {len(found)} rasters in the rain cube')
+        if found:
+            new_polygons = [polygons.get(names[i]) for i in new_gauges]
+            _, rows = extract_timeseries(x_coords[new_gauges], y_coords[new_gauges],
+                                         [paths[index['files'][i]] for i in found],
+                                         polygons=new_polygons if any(new_polygons) else None, radius=radius,
+                                         **kwargs)
+            old_new[found] = np.array(rows, dtype=np.float32)
+
+    # every gauge over the new rasters
+    new_rows = np.empty((0, len(gauges)), dtype=np.float32)
+    new_dates = []
+    if new_bils:
+        print(f'Extracting {len(gauges)} gauges from {len(new_bils)} new rasters')
+        all_polygons = [polygons.get(gauge) for gauge in gauges]
+        dates, rows = extract_timeseries(xs, ys, new_bils,
+                                         polygons=all_polygons if any(all_polygons) else None, radius=radius,
+                                         **kwargs)
+        new_rows = np.array(rows, dtype=np.float32).reshape(len(new_bils), len(gauges))
+        new_dates = [date.strftime('%Y-%m-%d') for date in dates]
+
+    vals = np.vstack([np.hstack([old_vals[:, keep_cols], old_new]), new_rows])
+    index = {'files': index['files'] + [os.path.basename(bil) for bil in new_bils],
+             'dates': index['dates'] + new_dates,
+             'gauges': gauges,
+             'x': xs.tolist(),
+             'y': ys.tolist(),
+             'modes': gauge_modes}
+    del old_vals  # release the memory map before its file is replaced
+
+    # written to temporary files first so that an interrupted update leaves the old cube readable
+    if not os.path.exists(cube_loc):
+        os.makedirs(cube_loc)
+    cube_file = os.path.join(cube_loc, 'cube.npy')
+    index_file = os.path.join(cube_loc, 'index.json')
+    np.save(cube_file + '.tmp.npy', vals)
+    with open(index_file + '.tmp', 'w') as f:
+        json.dump(index, f)
+    del vals
+    os.replace(cube_file + '.tmp.npy', cube_file)
+    os.replace(index_file + '.tmp', index_file)
+
+    return load_rain_cube(cube_loc, mmap=True)
+
+
+def repack_prism(bils, store_loc, chunks=(2048, 16, 16)):
+    """
+    Repacks prism rasters into a store of compressed chunks that are each a block of days over a block of pixels, so
+    that the whole time series of a pixel can be read from a few chunks instead of from every raster. The store is a
+    folder with a store.json of the grid, dates and chunk shape and one t.y.x.npz file per chunk. Each block of days
+    is first unpacked into a temporary memory mapped array in the store folder, which needs chunks[0] rasters' worth
+    of disk space. Each band of chunks[1] rows is then read from it once, which needs chunks[0] x chunks[1] rows of
+    memory (184 MB with the default chunks on the 4 km grid)
+
+    Args:
+        bils: list of full paths or /vsizip/ paths to .bil prism rasters. All must be on the same grid
+        store_loc: folder the store will be written to. will be created if it doesn't exist
+        chunks: the (days, rows, cols) shape of each chunk. With the default, a 30 year series of a pixel is spread
+                over 6 chunks of 2 MB (before compression)
 
-    return df
+    Returns:
+        None
 
+    """
+    if not bils:
+        raise ValueError('No rasters to repack')
+
+    start = time.time()
+    bils = sorted(bils, key=lambda bil: date_from_prism_file(bil))
+    header = read_bil_header(bils[0])
+    grid_keys = ('NROWS', 'NCOLS', 'ULXMAP', 'ULYMAP', 'XDIM', 'YDIM')
+    n_rows, n_cols = int(header['NROWS']), int(header['NCOLS'])
+    n_days = len(bils)
+    chunk_t, chunk_y, chunk_x = chunks
+
+    if not os.path.exists(store_loc):
+        os.makedirs(store_loc)
+    block_file = os.path.join(store_loc, 'block.tmp.npy')
+
+    for it, t0 in enumerate(range(0, n_days, chunk_t)):
+        block_bils = bils[t0:t0 + chunk_t]
+        block = None
+        for i, bil in enumerate(block_bils):
+            bil_header = read_bil_header(bil)
+            if any(bil_header[key] != header[key] for key in grid_keys):
+                raise ValueError(f'{bil} is not on the same grid as {bils[0]}')
+            raster = read_bil(bil, bil_header)
+            if block is None:
+                block = np.lib.format.open_memmap(block_file, mode='w+', dtype=raster.dtype,
+                                                  shape=(len(block_bils), n_rows, n_cols))
+            block[i] = raster
+
+        for iy, y0 in enumerate(range(0, n_rows, chunk_y)):
+            band = np.array(block[:, y0:y0 + chunk_y, :])  # each band is read from the block once
+            for ix, x0 in enumerate(range(0, n_cols, chunk_x)):
+                np.savez_compressed(os.path.join(store_loc, f'{it}.{iy}.{ix}.npz'),
+                                    data=band[:, :, x0:x0 + chunk_x])
+            del band
+        del block
+
+        now = time.time()
+        print(f'{t0 + len(block_bils)} of {n_days} rasters repacked. Elapsed time: {round((now-start)/60, 2)} '
+              f'minutes')
+
+    os.remove(block_file)
+    meta = {'header': header,
+            'chunks': list(chunks),
+            'dates': [date_from_prism_file(bil).strftime('%Y-%m-%d') for bil in bils],
+            'files': [os.path.basename(bil) for bil in bils]}
+    with open(os.path.join(store_loc, 'store.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+def store_pixels(store_loc, rows, cols):
+    """
+    Reads the full time series of a set of pixels from a store written by repack_prism. Each chunk holding one of
+    the pixels is read once
+
+    Args:
+        store_loc: folder of the store
+        rows: pixel rows, e.g. from bil_pixels
+        cols: pixel cols, e.g. from bil_pixels
+
+    Returns:
+        a tuple; one entry is the store's metadata and the other is a 2d array of vals (dates x pixels)
+
+    """
+    with open(os.path.join(store_loc, 'store.json')) as f:
+        meta = json.load(f)
+    chunk_t, chunk_y, chunk_x = meta['chunks']
+    n_days = len(meta['dates'])
+    rows = np.asarray(rows)
+    cols = np.asarray(cols)
+
+    vals = None
+    chunk_ids = np.column_stack([rows // chunk_y, cols // chunk_x])
+    for iy, ix in np.unique(chunk_ids, axis=0):
+        in_chunk = np.flatnonzero((chunk_ids[:, 0] == iy) & (chunk_ids[:, 1] == ix))
+        chunk_rows = rows[in_chunk] - iy*chunk_y
+        chunk_cols = cols[in_chunk] - ix*chunk_x
+        for it, t0 in enumerate(range(0, n_days, chunk_t)):
+            with np.load(os.path.join(store_loc, f'{it}.{iy}.{ix}.npz')) as chunk:
+                data = chunk['data']
+            if vals is None:
+                vals = np.empty((n_days, len(rows)), dtype=data.dtype)
+            vals[t0:t0 + len(data), in_chunk] = data[:, chunk_rows, chunk_cols]
+
+    if vals is None:
+        vals = np.empty((n_days, 0))
+
+    return meta, vals
+
+
+def store_timeseries(store_loc, x_coords, y_coords, polygons=None, radius=None):
+    """
+    Creates time series at a set of coordinates from a store written by repack_prism. Used by extract_timeseries
+
+    Args:
+        store_loc: folder of the store
+        x_coords: x coords
+        y_coords: y coords
+        polygons: optional polygons of the coordinates' basins, as in extract_timeseries
+        radius: optional radius in km of the area around coordinates without a polygon
+
+    Returns:
+        a tuple; one entry is a list of dates and the other is a 2d array of vals (dates x coordinates)
+
+    """
+    start = time.time()
+    with open(os.path.join(store_loc, 'store.json')) as f:
+        header = json.load(f)['header']
+
+    if polygons is not None or radius is not None:
+        weights, rows, cols = basin_weights(header, x_coords, y_coords, polygons=polygons, radius=radius)
+        meta, vals = store_pixels(store_loc, rows, cols)
+        vals = basin_average(weights, vals, header)
+    else:
+        rows, cols = bil_pixels(header, x_coords, y_coords)
+        meta, vals = store_pixels(store_loc, rows, cols)
+
+    dates = [datetime.strptime(date, '%Y-%m-%d') for date in meta['dates']]
+
+    elap = round(time.time()-start, 2)
+    print(f'FINISHED. Elapsed time: {elap/60} minutes')
+
+    return dates, vals
@@ -3,8 +3,11 @@ Functions for reading formatted gauge data in and extracting statistics
 """
 
 
+import warnings
+
 import pandas as pd
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
 from compression import *
 
@@ -29,6 +32,32 @@ def clean_read(file, nodata_val=-999):
     return df
 
 
+def _window_devs(whys, window_size):
+    """
+    Gets the stddev of the non-nan values in every window of window_size - 1 points, with nan where a window has
+    fewer than 2 values. Entry i is the window starting at index i
+    """
+    whys = np.asarray(whys)
+    valid = ~np.isnan(whys)  # raises a TypeError for malformed (non-numeric) data
+    whys = whys.astype(float)
+
+    windows = sliding_window_view(whys, window_size - 1)
+    in_window = sliding_window_view(valid, window_size - 1)
+
+    # windows with the same number of values are compacted into one array, so each row is summed over exactly its
+    # own values in their original order, as np.std sums the nan-stripped window. Summing zero-filled rows instead
+    # would round differently
+    counts = in_window.sum(axis=1)
+    devs = np.full(len(counts), np.nan)
+    for size in np.unique(counts[counts >= 2]):
+        rows = np.flatnonzero(counts == size)
+        compact = windows[rows][in_window[rows]].reshape(len(rows), size)
+        means = compact.sum(axis=1, keepdims=True) / size
+        devs[rows] = np.sqrt(((compact - means) ** 2).sum(axis=1) / size)
+
+    return devs
+
+
 def window_stddev(whys, window_size, step=1):
     """
     Returns the average standard deviation for a set of data by grabbing stddevs using a moving window
@@ -43,17 +72,13 @@ def window_stddev(whys, window_size, step=1):
         a float representing the average stddev
 
     """
-    devs = []
-    for i in range(0, len(whys)-window_size, step):
-        sub_y = np.array(whys[i:(i + (window_size - 1))])
-        sub_y = sub_y[~np.isnan(sub_y)]
-        if len(sub_y) < 2:
-            devs.append(np.nan)
-        else:
-            dev = np.std(sub_y)
-            devs.append(dev)
+    n_windows = len(range(0, len(whys)-window_size, step))
+    if n_windows == 0:
+        return np.nan
+
+    devs = _window_devs(whys[:(n_windows-1)*step + window_size - 1], window_size)[::step]
 
-    if not all(np.isnan(x) for x in devs):
+    if not np.all(np.isnan(devs)):
         return np.mean(devs)
     else:
         return np.nan
@@ -78,7 +103,78 @@ def typical_stddev(whys, at_index, history_length=28, window_size=14, step=2):
     return window_stddev(subset, window_size=window_size, step=step)
 
 
-def segment_view(df, why_col, threshold, index, width):
+def typical_stddev_series(whys, history_length=28, window_size=14, step=2):
+    """
+    Finds the representative stdev (see typical_stddev) for every index of a series at once, so that looking up
+    the stddev for an index is just an array index
+
+    Args:
+        whys: y data
+        history_length: number of data points to include in history subset
+        window_size: number of points in moving window
+        step: index increment size for moving window
+
+    Returns:
+        a np array where entry i is typical_stddev(whys, i, history_length, window_size, step). Indices without a
+        full history are nan
+
+    """
+    n = len(whys)
+    typical = np.full(n, np.nan)
+    n_windows = len(range(0, history_length-window_size, step))
+    if n_windows == 0 or n < history_length:
+        return typical
+
+    devs = _window_devs(whys, window_size)
+    # the history for index i starts at i - history_length, and its windows start every step from there
+    firsts = np.arange(0, n - history_length + 1)
+    picks = devs[firsts[:, None] + np.arange(n_windows) * step]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        typical[history_length:] = np.mean(picks, axis=1)[:n - history_length]
+
+    return typical
+
+
+def view_subset(df, why_col, index, width):
+    """
+    Gets the non-null subset of a df column that segment_view operates on
+
+    Args:
+        df: a pandas df
+        why_col: col name for the y values
+        index: the ABSOLUTE index of the row to center the subset on
+        width: the number of rows to include in the subset, centered on index
+
+    Returns:
+        a pd Series, indexed by the ABSOLUTE indices of the rows
+
+    """
+    slicer = (index-int(width/2), index+int(width/2))
+    subdf = df[why_col].loc[slicer[0]:slicer[1]]
+    return subdf.dropna()
+
+
+def view_tree(df, why_col, index, width):
+    """
+    Builds the full greedy split tree for a view so that segment_view and get_preeffect_window can be run for any
+    number of thresholds without segmenting the view again
+
+    Args:
+        df: a pandas df
+        why_col: col name for the y values
+        index: the ABSOLUTE index of the row to center the subset on
+        width: the number of rows to include in the subset, centered on index
+
+    Returns:
+        a tuple (exes, tree), where exes are the ABSOLUTE indices of the view and tree is the output of split_tree
+
+    """
+    subdf = view_subset(df, why_col, index, width)
+    return subdf.index, split_tree(subdf.index, subdf)
+
+
+def segment_view(df, why_col, threshold, index, width, method='greedy', tree=None):
     """
     Recursively segments a a subset of a pandas df by fitting a line to data and splitting the data if an
     error theshold is exceeded
@@ -89,19 +185,30 @@ def segment_view(df, why_col, threshold, index, width):
         threshold: the maximum error threshold allowed
         index: the ABSOLUTE index of the row to center the subset on
         width: the number of rows to include in the subset, centered on index
+        method: the segmentation engine. 'greedy' for linear_iterate (same result as linear_recurse) or 'pelt' for
+                pelt_segment
+        tree: optional output of view_tree for the same view. If passed, the greedy segments are cut from the tree
+              instead of being recomputed and df, index, width and method are ignored
 
     Returns:
         a list of tuples of the ABSOLUTE (not relative) indices (inclusive:exclusive) of the segments
 
     """
-    slicer = (index-int(width/2), index+int(width/2))
-    subdf = df[why_col].loc[slicer[0]:slicer[1]]
-    subdf = subdf.dropna()
-
-    exes = subdf.index
-    whys = subdf
+    if tree is not None:
+        exes, split = tree
+        res = cut_tree(split, threshold)
+    else:
+        subdf = view_subset(df, why_col, index, width)
+        exes = subdf.index
+        whys = subdf
+
+        if method == 'greedy':
+            res = linear_iterate(exes, whys, threshold=threshold, sums=True)
+        elif method == 'pelt':
+            res = pelt_segment(exes, whys, threshold=threshold)
+        else:
+            raise ValueError(f'Unknown segmentation method {method}')
 
-    res = linear_recurse(exes, whys, threshold=threshold)
     starts = [exes[i[0]] for i in res]
     ends = [exes[i[1]-1]+1 for i in res]
     #e_norms = [i[2] for i in res]
@@ -110,7 +217,7 @@ def segment_view(df, why_col, threshold, index, width):
     return ses
 
 
-def get_preeffect_window(df, why_col, threshold, index, width, min_win=5, max_win=28):
+def get_preeffect_window(df, why_col, threshold, index, width, min_win=5, max_win=28, method='greedy', tree=None):
     """
     Gets the preeffect window for an index by subsetting a df around an index and then
     recursively splitting it. The window's end is always the index (exclusive).
@@ -123,13 +230,15 @@ def get_preeffect_window(df, why_col, threshold, index, width, min_win=5, max_wi
         width: the number of rows to include in the subset, centered on index
         min_win: min window length (inclusive)
         max_win: max window length (inclusive)
+        method: the segmentation engine passed to segment_view
+        tree: optional output of view_tree for the same view, so that threshold sweeps only cut the tree
 
     Returns:
         a list (len 2) of the ABSOLUTE (not relative) indices (inclusive:exclusive) of the window
 
     """
 
-    segs = segment_view(df, why_col, threshold, index, width)
+    segs = segment_view(df, why_col, threshold, index, width, method=method, tree=tree)
     segs.reverse()
 
     for seg in segs:
@@ -180,3 +289,102 @@ def analyze_window(df, why_col, window, stddev_drop=True):
 
     return mean, stddev, n_window, n_drop
 
+
+def analyze_windows(whys, windows, stddev_drop=True):
+    """
+    Like analyze_window, but for many windows of the same data at once. The windows are gathered into one padded
+    array and masked instead of being sliced out one at a time. The results are identical to analyze_window's
+
+    Args:
+        whys: y data
+        windows: a list of windows or an array of shape (n, 2), each (inclusive:exclusive) positional indices
+        stddev_drop: if True, points outside of 1.5sd are removed and the stats recalculated, as in analyze_window
+
+    Returns:
+        a tuple of np arrays (means, stddevs, n_points, removed_points_due_to_sd), with one entry per window
+
+    """
+    whys = np.asarray(whys, dtype=float)
+    windows = np.asarray(windows, dtype=int).reshape(-1, 2)
+    starts = np.clip(windows[:, 0], 0, len(whys))
+    ends = np.clip(windows[:, 1], starts, len(whys))
+
+    lengths = ends - starts
+    offsets = np.arange(max(lengths.max(initial=0), 1))
+    inside = offsets < lengths[:, None]
+    padded = np.append(whys, np.nan)  # positions past the end of a window read the trailing nan
+    vals = padded[np.where(inside, starts[:, None] + offsets, len(whys))]
+    valid = inside & ~np.isnan(vals)
+
+    def stats(mask):
+        # windows with the same number of points are compacted into one array, so each row is summed over exactly
+        # its own points in their original order, as pandas sums the dropna'd slice. Summing padded rows instead
+        # would round differently and could move points across the 1.5sd cut
+        n = mask.sum(axis=1)
+        mean = np.full(len(n), np.nan)
+        stddev = np.full(len(n), np.nan)
+        for size in np.unique(n[n > 0]):
+            rows = np.flatnonzero(n == size)
+            compact = vals[rows][mask[rows]].reshape(len(rows), size)
+            mean[rows] = compact.sum(axis=1) / size
+            stddev[rows] = np.sqrt(((mean[rows][:, None] - compact) ** 2).sum(axis=1) / size)
+        return mean, stddev, n
+
+    mean, stddev, n_window = stats(valid)
+    n_drop = np.zeros(len(windows), dtype=int)
+
+    if stddev_drop:
+        ma = mean + stddev*1.5
+        mi = mean - stddev*1.5
+
+        with np.errstate(invalid='ignore'):
+            kept = valid & (vals >= mi[:, None]) & (vals <= ma[:, None])
+        cut_mean, stddev, cut_n = stats(kept)
+
+        n_drop = n_window - cut_n
+        n_window = cut_n
+        mean = cut_mean
+
+    return mean, stddev, n_window, n_drop
+
+
+def preeffect_analysis(df, why_col, threshold, index, width, min_win=5, max_win=28, method='greedy',
+                       stddev_drop=True, cache=None):
+    """
+    Runs get_preeffect_window and then analyze_window on the resulting window, optionally reusing results from
+    a persistent cache
+
+    Args:
+        df: a pandas df
+        why_col: col name for the y values
+        threshold: the maximum error threshold allowed
+        index: the ABSOLUTE index of the row to center the subset on
+        width: the number of rows to include in the subset, centered on index
+        min_win: min window length (inclusive)
+        max_win: max window length (inclusive)
+        method: the segmentation engine passed to segment_view
+        stddev_drop: passed to analyze_window
+        cache: an optional window_cache.WindowCache
+
+    Returns:
+        a tuple (window, (mean, stddev, n_points, removed_points_due_to_sd))
+
+    """
+    if cache is not None:
+        # every value either function can read
+        lo = min(index - int(width/2), index - max(min_win, max_win))
+        data = df[why_col].loc[lo:index + int(width/2)]
+        key = cache.make_key(data, int(index), float(threshold), width, min_win, max_win, method, stddev_drop)
+        cached = cache.get(key)
+        if cached is not None:
+            window, stats = cached
+            return window, tuple(stats)
+
+    window = get_preeffect_window(df, why_col, threshold, index, width, min_win=min_win, max_win=max_win,
+                                  method=method)
+    stats = analyze_window(df, why_col, window, stddev_drop=stddev_drop)
+
+    if cache is not None:
+        cache.put(key, [[int(i) for i in window], [float(stats[0]), float(stats[1]), int(stats[2]), int(stats[3])]])
+
+    return window, stats
@@ -0,0 +1,24 @@
+"""
+One-off conversion of the prism archive into a chunked store that extract_timeseries can read whole time series from,
+so that adding a gauge does not mean opening every daily raster. Run as a script
+"""
+
+from raster_extraction import *
+
+parent = r'E:\hurricane\prism'
+# folder where prism rain data is stores
+prism_zipped = False
+# if True, the prism rasters are read straight from the .zip archives they are distributed in, which are in the
+# subfolders of parent
+store_loc = r'E:\hurricane\prism_store'
+# folder the store will be written to. needs roughly the size of the compressed archive, plus chunks[0] rasters'
+# worth of space while it is being written
+chunks = (2048, 16, 16)
+# the (days, rows, cols) shape of each chunk. more days per chunk means fewer chunks per time series but more
+# temporary space while writing
+
+###############################
+
+if __name__ == '__main__':
+    bils = get_bils(parent, zipped=prism_zipped)
+    repack_prism(bils, store_loc, chunks=chunks)
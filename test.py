@@ -4,6 +4,7 @@ Junk code for exploring ideas
 
 import random
 import math
+import time
 
 import pandas as pd
 import numpy as np
@@ -59,7 +60,12 @@ nex = [exes[i] for i in val_range]
 ny = [func_linear(i, m, b) for i in nex]
 """
 
+t0 = time.time()
 res = linear_recurse(exes, whys, thresh, None)
+t1 = time.time()
+pelt_res = pelt_segment(exes, whys, thresh)
+t2 = time.time()
+print(f'greedy: {len(res)} segments in {round(t1-t0, 4)} s. pelt: {len(pelt_res)} segments in {round(t2-t1, 4)} s')
 
 starts = [i[0] for i in res]
 ends = [i[1] for i in res]
@@ -72,6 +78,12 @@ plt.plot(exes, whys)
 for s in ses:
     plt.plot(exes[s[0]:s[1]], whys[s[0]:s[1]])
 
+plt.figure()
+plt.plot(exes, whys)
+for s in pelt_res:
+    plt.plot(exes[s[0]:s[1]], whys[s[0]:s[1]])
+plt.title('pelt')
+
 """
 f = 32
 t = 100
@@ -0,0 +1,118 @@
+"""
+An opt-in persistent cache of pre-effect window results, stored in a local SQLite file. Results are keyed by a hash of
+the gauge data they were computed from plus the arguments used, so re-runs only recompute windows whose data or
+settings changed
+"""
+
+import hashlib
+import json
+import sqlite3
+
+import numpy as np
+
+
+class WindowCache:
+    """
+    A size-bounded, least-recently-used store of pre-effect window results
+
+    Args:
+        path: path to the SQLite file. Will be created if it doesn't exist
+        max_entries: the maximum number of results kept. The least recently used results are evicted past this
+        commit_every: the number of puts between writes to disk, so that a run that crashes keeps most of what it
+                      cached
+    """
+
+    def __init__(self, path, max_entries=1000000, commit_every=100):
+        self.path = path
+        self.max_entries = max_entries
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS windows '
+                          '(key TEXT PRIMARY KEY, value TEXT NOT NULL, used INTEGER NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS windows_used ON windows (used)')
+        self.clock = self.conn.execute('SELECT COALESCE(MAX(used), 0) FROM windows').fetchone()[0]
+        self.count = self.conn.execute('SELECT COUNT(*) FROM windows').fetchone()[0]
+        # kept up to date on every put so that the table isn't counted each time
+
+    @staticmethod
+    def make_key(data, *args):
+        """
+        Makes a cache key from a data subset and the arguments used to compute a result from it
+
+        Args:
+            data: a pd Series. Its index and values (including nans) are hashed
+            *args: other values that determine the result. Must have a stable repr
+
+        Returns:
+            a hex digest
+
+        """
+        h = hashlib.sha1()
+        h.update(np.ascontiguousarray(data.index, dtype=np.int64).tobytes())
+        h.update(np.ascontiguousarray(data, dtype=float).tobytes())
+        h.update(repr(args).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        """
+        Gets a cached result
+
+        Args:
+            key: a key from make_key
+
+        Returns:
+            the cached result, or None if it isn't cached
+
+        """
+        row = self.conn.execute('SELECT value FROM windows WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.clock += 1
+        self.conn.execute('UPDATE windows SET used = ? WHERE key = ?', (self.clock, key))
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        """
+        Caches a result, evicting the least recently used results if the cache is full
+
+        Args:
+            key: a key from make_key
+            value: a json serializable result
+
+        Returns:
+            Nothing
+
+        """
+        self.clock += 1
+        exists = self.conn.execute('SELECT 1 FROM windows WHERE key = ?', (key,)).fetchone() is not None
+        self.conn.execute('INSERT OR REPLACE INTO windows (key, value, used) VALUES (?, ?, ?)',
+                          (key, json.dumps(value), self.clock))
+        if not exists:
+            self.count += 1
+
+        if self.count > self.max_entries:
+            cursor = self.conn.execute('DELETE FROM windows WHERE key IN '
+                                       '(SELECT key FROM windows ORDER BY used LIMIT ?)',
+                                       (self.count - self.max_entries,))
+            self.count -= cursor.rowcount
+
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        """
+        Writes the cache to disk and closes it
+        """
+        self.conn.commit()
+        self.conn.close()
+
+    def __repr__(self):
+        return f'WindowCache({self.path!r}, hits={self.hits}, misses={self.misses})'